@@ -0,0 +1,236 @@
+
+# coding: utf-8
+
+
+import os
+import json
+import time
+import shutil
+import argparse
+import platform
+import multiprocessing
+import concurrent.futures
+import numpy as np
+import skimage
+import skimage.draw
+import skimage.io
+import implementations
+
+""" Benchmark of the database builder on synthetic wafers.
+Generates wafers in the format of the original data (BF and magFluo tifs, tissue and mag txt files with
+the polygon corners in 3x coordinates as expected by import_txt), times create_database in random and
+ordered mode and the loading of the random database by SlicesDataset, and writes the results as json
+so that runs of different versions can be compared. Every stage runs in a new process, so that its peak
+memory is its own.
+usage: python benchmark.py --work-dir /tmp/benchmark --output benchmark.json"""
+
+
+def noise_image(rng, mean, std, shape, block_rows = 256):
+    """ Returns a uint8 image of gaussian noise clipped to [0, 255]. The noise is drawn by blocks of
+    block_rows rows, so that no full size float image is allocated."""
+    image = np.empty(shape, dtype = np.uint8)
+    for first in range(0, shape[0], block_rows):
+        rows = min(block_rows, shape[0] - first)
+        image[first:first + rows] = rng.normal(mean, std, (rows,) + tuple(shape[1:])).clip(0, 255)
+    return image
+
+
+
+def generate_wafer(data_path, height, width, n_sections, rng):
+    """ This function generates one synthetic wafer folder in data_path.
+    Sections are laid on a jittered grid as on a real wafer: every section is a rotated tissue rectangle,
+    darker in the BF image, with a smaller magnetic rectangle on one side, bright in the magFluo image."""
+    if not os.path.exists(data_path):
+        os.makedirs(data_path)
+
+    bf = noise_image(rng, 180, 10, (height, width))
+    mf = noise_image(rng, 20, 5, (height, width))
+
+    # one grid cell per section
+
+    n_rows = int(np.ceil(np.sqrt(n_sections * height / width)))
+    n_cols = int(np.ceil(n_sections / n_rows))
+    cell = min(height / n_rows, width / n_cols)
+
+    tissue_lines = []
+    mag_lines = []
+    for k in range(n_sections):
+        center = np.array([(k // n_cols + 0.5) * height / n_rows, (k % n_cols + 0.5) * width / n_cols])
+        center = center + rng.uniform(-0.1, 0.1, 2) * cell
+        angle = rng.uniform(0, np.pi)
+        axes = np.array([[np.cos(angle), np.sin(angle)], [-np.sin(angle), np.cos(angle)]])
+
+        # corners as (row, col) of the tissue and of the mag rectangle next to it
+
+        half = np.array([0.3, 0.2]) * cell
+        square = np.array([[-1, -1], [-1, 1], [1, 1], [1, -1]])
+        tissue = center + (square * half) @ axes
+        mag = center + (square * half * [0.4, 0.3] + [0, half[1] * 1.5]) @ axes
+
+        for corners, image, value, lines in [(tissue, bf, 90, tissue_lines), (mag, mf, 230, mag_lines)]:
+            rr, cc = skimage.draw.polygon(corners[:, 0], corners[:, 1], shape = (height, width))
+            image[rr, cc] = value
+            lines.append("\t".join(f"{int(col * 3)},{int(row * 3)}" for row, col in corners) + "\n")
+
+    name = os.path.basename(data_path)
+    skimage.io.imsave(os.path.join(data_path, f"{name}_BF_intensityCorrected.tif"), bf, check_contrast = False)
+    skimage.io.imsave(os.path.join(data_path, f"{name}_magFluo.tif"), mf, check_contrast = False)
+    with open(os.path.join(data_path, f"{name}_tissue.txt"), "w") as f:
+        f.writelines(tissue_lines)
+    with open(os.path.join(data_path, f"{name}_mag.txt"), "w") as f:
+        f.writelines(mag_lines)
+
+
+
+def generate_data(data_path, n_wafers, height, width, n_sections, seed = 0):
+    """ This function generates n_wafers synthetic wafer folders in data_path, as given to create_database."""
+    rng = np.random.default_rng(seed)
+    for k in range(n_wafers):
+        generate_wafer(os.path.join(data_path, f"wafer_{k}"), height, width, n_sections, rng)
+
+
+
+def benchmark_generate(data_path, n_wafers, height, width, n_sections, seed = 0):
+    """ Times the generation of the synthetic wafers from scratch. Returns the measures as a dict."""
+    if os.path.exists(data_path):
+        shutil.rmtree(data_path)
+
+    start = time.perf_counter()
+    generate_data(data_path, n_wafers, height, width, n_sections, seed)
+    return {"seconds": time.perf_counter() - start, "bytes": directory_size(data_path)}
+
+
+
+def measure(function, *args, **kwargs):
+    """ Calls function(*args, **kwargs) in a new spawned process and returns its result dict, with the
+    peak memory of that process and of its largest worker process (see implementations.peak_rss).
+    The peak resident memory of a process covers its whole life, so every stage gets its own process."""
+    context = multiprocessing.get_context("spawn")
+    with concurrent.futures.ProcessPoolExecutor(max_workers = 1, mp_context = context) as executor:
+        return executor.submit(_measured_call, function, args, kwargs).result()
+
+
+
+def _measured_call(function, args, kwargs):
+    # runs in the process of measure
+    result = function(*args, **kwargs)
+    result["peak_rss"] = implementations.peak_rss()
+    return result
+
+
+
+def directory_size(path):
+    """ Returns the total size in bytes of the files in path and its subdirectories."""
+    size = 0
+    for root, _, files in os.walk(path):
+        size += sum(os.path.getsize(os.path.join(root, name)) for name in files)
+    return size
+
+
+
+def benchmark_create_database(data_path, database_path, patch_dimensions, patch_number, inference, **kwargs):
+    """ Times create_database from scratch in random (inference = False) or ordered mode.
+    kwargs are passed to create_database. Returns the measures as a dict, with the time of every stage
+    of every image as saved by create_database in profile.json."""
+    if os.path.exists(database_path):
+        shutil.rmtree(database_path)
+
+    start = time.perf_counter()
+    patches = implementations.create_database(data_path, database_path, patch_dimensions, patch_number,
+                                              inference = inference, profile = True, **kwargs)
+    seconds = time.perf_counter() - start
+
+    with open(os.path.join(database_path, "profile.json")) as f:
+        profile = json.load(f)
+
+    return {"seconds": seconds,
+            "patches": patches,
+            "patches_per_second": patches / seconds,
+            "bytes_written": directory_size(database_path),
+            "profile": profile}
+
+
+
+def benchmark_loading(database_path, patch_number, channels = ["base", "mf", "edges"]):
+    """ Times the loading of every image and mask of a random database by SlicesDataset.
+    Returns the measures as a dict, or the reason why it was skipped when mrcnn is not installed."""
+    try:
+        import slices
+    except ImportError as error:
+        return {"skipped": str(error)}
+
+    n_images = len([x for x in os.listdir(database_path) if os.path.isdir(os.path.join(database_path, x))])
+
+    start = time.perf_counter()
+    dataset = slices.SlicesDataset()
+    dataset.load_slices(database_path, n_images, patch_number, channels = channels)
+    dataset.prepare()
+    setup_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for image_id in dataset.image_ids:
+        dataset.load_image(image_id)
+        dataset.load_mask(image_id)
+    seconds = time.perf_counter() - start
+
+    return {"setup_seconds": setup_seconds,
+            "seconds": seconds,
+            "patches": len(dataset.image_ids),
+            "patches_per_second": len(dataset.image_ids) / seconds}
+
+
+
+def run_benchmark(work_dir, n_wafers = 2, height = 4096, width = 4096, n_sections = 40, patch_size = 512,
+                  patch_number = 50, workers = 1, seed = 0, output_format = "tiff"):
+    """ Generates the synthetic wafers in work_dir/data, builds the random and ordered databases in
+    work_dir and loads the random one. Returns the parameters and the measures of every stage."""
+    parameters = dict(n_wafers = n_wafers, height = height, width = width, n_sections = n_sections,
+                      patch_size = patch_size, patch_number = patch_number, workers = workers, seed = seed,
+                      output_format = output_format)
+    results = {"parameters": parameters,
+               "platform": {"python": platform.python_version(), "numpy": np.__version__,
+                            "machine": platform.machine(), "cpu_count": os.cpu_count()},
+               "date": time.strftime("%Y-%m-%dT%H:%M:%S")}
+
+    data_path = os.path.join(work_dir, "data")
+    print("Generating wafers...")
+    results["generate"] = measure(benchmark_generate, data_path, n_wafers, height, width, n_sections, seed)
+
+    patch_dimensions = [patch_size, patch_size]
+    options = dict(workers = workers, seed = seed, output_format = output_format)
+
+    print("Benchmarking random mode...")
+    results["random"] = measure(benchmark_create_database, data_path, os.path.join(work_dir, "random"),
+                                patch_dimensions, patch_number, False, **options)
+    print("Benchmarking ordered mode...")
+    results["ordered"] = measure(benchmark_create_database, data_path, os.path.join(work_dir, "ordered"),
+                                 patch_dimensions, patch_number, True, save_all = False, **options)
+    print("Benchmarking loading...")
+    results["loading"] = measure(benchmark_loading, os.path.join(work_dir, "random"), patch_number)
+
+    return results
+
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description = "Benchmark create_database and SlicesDataset on synthetic wafers.")
+    parser.add_argument("--work-dir", required = True, help = "directory for the synthetic data and databases")
+    parser.add_argument("--output", default = "benchmark.json", help = "json file of the results")
+    parser.add_argument("--wafers", type = int, default = 2)
+    parser.add_argument("--height", type = int, default = 4096)
+    parser.add_argument("--width", type = int, default = 4096)
+    parser.add_argument("--sections", type = int, default = 40, help = "sections per wafer")
+    parser.add_argument("--patch-size", type = int, default = 512)
+    parser.add_argument("--patch-number", type = int, default = 50, help = "random patches per wafer")
+    parser.add_argument("--workers", type = int, default = 1)
+    parser.add_argument("--seed", type = int, default = 0)
+    parser.add_argument("--format", default = "tiff", choices = ["tiff", "packed"])
+    args = parser.parse_args()
+
+    results = run_benchmark(args.work_dir, args.wafers, args.height, args.width, args.sections, args.patch_size,
+                            args.patch_number, args.workers, args.seed, args.format)
+
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent = 2)
+    print(json.dumps(results, indent = 2))
@@ -0,0 +1,70 @@
+
+# coding: utf-8
+
+
+import numpy as np
+import skimage
+import skimage.filters
+
+""" Registry of the derived channels which SlicesDataset can compute from the stored channels.
+A derived channel is a function of one or more channels ("base", "mf" or other derived channels) of a
+patch, returning a 2D image converted to 8 bit by skimage.img_as_ubyte. Channels stored in the database
+are always read from it, derived channels are computed when they are not stored, so new channel
+combinations can be tried without creating the database again:
+
+    channels.register_channel("mf_gradient", ["mf"], gradient)
+    dataset.load_slices(TRAIN_DIR, 3, 40, channels = ["base", "mf_gradient"])
+
+Derived channels are computed on the patch alone, so filters differ from the ones computed on the
+whole image by create_database along the patch borders."""
+
+DERIVED_CHANNELS = {}
+
+
+def register_channel(name, sources, function):
+    """ Declares the derived channel name, computed as function(*images of the sources channels)."""
+    DERIVED_CHANNELS[name] = (list(sources), function)
+
+
+
+def is_derived(name):
+    """ Checks if name is a registered derived channel."""
+    return name in DERIVED_CHANNELS
+
+
+
+def derive(name, load):
+    """ Computes the derived channel name. load is a function returning the 8 bit image of a channel
+    of the same patch, called for the sources of the channel."""
+    sources, function = DERIVED_CHANNELS[name]
+    return skimage.img_as_ubyte(function(*[load(source) for source in sources]))
+
+
+
+def edges(image):
+    """ Sobel edge magnitude, as the "edge" channel of create_database."""
+    return skimage.filters.sobel(image)
+
+
+
+def gradient(image):
+    """ Magnitude of the central differences gradient, in gray levels, clipped to 255."""
+    gy, gx = np.gradient(image.astype(np.float32))
+    return np.clip(np.rint(np.hypot(gy, gx)), 0, 255).astype(np.uint8)
+
+
+
+def normalized(image):
+    """ Contrast normalized image: zero mean and unit standard deviation over the patch, mapped to
+    128 + 32 * z and clipped, so that 4 standard deviations are kept on both sides."""
+    image = image.astype(np.float32)
+    z = (image - image.mean()) / max(float(image.std()), 1e-6)
+    return np.clip(np.rint(128 + 32 * z), 0, 255).astype(np.uint8)
+
+
+
+register_channel("edges", ["base"], edges)
+register_channel("mf_edges", ["mf"], edges)
+register_channel("gradient", ["base"], gradient)
+register_channel("normalized", ["base"], normalized)
+register_channel("mf_normalized", ["mf"], normalized)
@@ -1,4 +1,5 @@
 import implementations
+import logging
 import os
 
 """ simple script to call create_database function"""
@@ -7,11 +8,18 @@ data_path = os.path.join(os.path.dirname(os.path.abspath("")),"data")
 
 patched_data_path = os.path.join(os.path.dirname(os.path.abspath("")),"patched_data_ordered")
 
-if not os.path.exists(patched_data_path):
-    os.mkdir(patched_data_path)
-
 patch_dimensions = [512,512]
 n_patches = 50
 
-implementations.create_database(data_path, patched_data_path, patch_dimensions, n_patches,
-                               inference = True, ovl = 0, save_all = False)
+# the guard is needed by the process pool on platforms which spawn new interpreters (Windows)
+
+if __name__ == "__main__":
+    
+    logging.basicConfig(level = logging.INFO, format = "%(asctime)s %(message)s")
+    
+    if not os.path.exists(patched_data_path):
+        os.mkdir(patched_data_path)
+    
+    implementations.create_database(data_path, patched_data_path, patch_dimensions, n_patches,
+                                   inference = True, ovl = 0, save_all = False, workers = os.cpu_count())
+
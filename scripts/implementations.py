@@ -5,371 +5,985 @@
 import skimage
 import os 
 import sys
+import time
+import json
+import shutil
+import concurrent.futures
+import contextlib
+import logging
 import numpy as np
+import tifffile
+import packed
+import tiling
+import wafer_image
+
+try:
+    import resource
+except ImportError:
+    # not available on Windows, peak memory is not reported
+    resource = None
+
+logger = logging.getLogger(__name__)
 
 
 def import_txt(path):
-    """ This function imports the coordinates of the corners of the given masks from the txt file as an array."""
+    """ This function imports the coordinates of the corners of the given masks from the txt file as an array.
+    Every line of the file is a polygon, given by its corners as whitespace separated "x,y" pairs.
+    Coordinates are divided by 3 (truncated). Returns a (n_polygons, n_corners, 2) int array, or a 1D object
+    array of (n_corners, 2) arrays when polygons have different numbers of corners.
+    The result is cached next to the file in {path}.npy and reused until the file changes."""
+    stat = os.stat(path)
+    cache_path = path + ".npy"
+    
+    # cached array: mtime, size, number of polygons, corners of each polygon and flat coordinates
+    
+    if os.path.exists(cache_path):
+        cache = np.load(cache_path)
+        if cache[0] == stat.st_mtime_ns and cache[1] == stat.st_size:
+            n_polygons = cache[2]
+            return split_polygons(cache[3:3+n_polygons].astype(int), cache[3+n_polygons:].astype(int).reshape(-1, 2))
+    
     with open(path) as p:
-            positions = []
-            for line in p:
-                coord = [str(x) for x in line.split()]
-                for i in range(len(coord)):
-                    txt = str(coord[i])
-                    x, y = txt.split(',')
-                    coord[i] = [int(int(x) / 3), int(int(y) / 3)]
-                positions.append(coord)
-            positions = np.asarray(positions)
+        lines = [line for line in p if line.strip()]
+    
+    counts = np.array([line.count(',') for line in lines], dtype = int)
+    values = np.array("".join(lines).replace(',', ' ').split(), dtype = np.int64)
+    corners = np.trunc(values / 3).astype(int).reshape(-1, 2)
+    
+    try:
+        cache = np.concatenate([[stat.st_mtime_ns, stat.st_size, len(counts)], counts, corners.ravel()])
+        np.save(cache_path + ".tmp.npy", cache.astype(np.int64))
+        os.replace(cache_path + ".tmp.npy", cache_path)
+    except OSError:
+        # read only data, no cache
+        pass
+    
+    return split_polygons(counts, corners)
+
+
+
+def split_polygons(counts, corners):
+    """ Splits the (n, 2) corners of all polygons into polygons of counts[i] corners, as returned by import_txt."""
+    if len(counts) == 0:
+        return np.zeros((0, 0, 2), dtype = int)
+    if (counts == counts[0]).all():
+        return corners.reshape(len(counts), counts[0], 2)
+    positions = np.empty(len(counts), dtype = object)
+    positions[:] = np.split(corners, np.cumsum(counts)[:-1])
     return positions
       
 
 
-def is_not_empty(positions_t, positions_m, boundaries):
-    """ This function checks if there is any mask in boundaries, used to discard empty patches.
-    Loads tissue masks from positions_t and magnetic masks from positions_m.
-    Checks if any of the corners in positions_t or positions_m is in boundaries."""
-    tflag = False
-    mflag = False
+class PolygonIndex:
+    """ Spatial index of the tissue and magnetic polygons of one image.
+    The bounding boxes of all polygons are stored in numpy arrays when the index is built, so that
+    the polygons touching a patch window are found with one vectorized comparison per class.
+    Built once per image from the import_txt output of the tissue and mag files."""
     
-    for l in range(len(positions_t)):
-        barray1 = ( [boundaries[0][0] < positions_t[l,j,1] < boundaries[0][1] and
-                 boundaries[1][0] < positions_t[l,j,0] < boundaries[1][1] 
-                 for j in range(positions_t.shape[1]) ] ) # boolean array for checking
-        if any(barray1):
-            tflag = True
-            break
-    for l in range(len(positions_m)):
-        barray2 = ( [boundaries[0][0] < positions_m[l,j,1] < boundaries[0][1] and
-                 boundaries[1][0] < positions_m[l,j,0] < boundaries[1][1] 
-                 for j in range(positions_m.shape[1]) ] ) # boolean array for checking
-        if any(barray2):
-            mflag=True
-            break
-    return tflag, mflag
+    def __init__(self, positions_t, positions_m):
+        self.positions_t = positions_t
+        self.positions_m = positions_m
+        self.bboxes_t = polygon_bboxes(positions_t)
+        self.bboxes_m = polygon_bboxes(positions_m)
+    
+    def query(self, boundaries):
+        """ Returns the indices of the tissue and mag polygons whose bounding box intersects the window
+        boundaries = [[y1, y2], [x1, x2]], y2 and x2 excluded."""
+        t_idx = np.flatnonzero(bboxes_intersect(self.bboxes_t, boundaries))
+        m_idx = np.flatnonzero(bboxes_intersect(self.bboxes_m, boundaries))
+        return t_idx, m_idx
+    
+    def patch_masks(self, boundaries, stages = None):
+        """ Returns the lists of non empty tissue and mag masks of the window, in polygon order.
+        The window is empty when both lists are empty, also when a polygon covers the whole window.
+        stages is an optional StageTimer, the rasterization is timed as its "polygons" stage."""
+        stages = stages or NO_STAGES
+        t_idx, m_idx = self.query(boundaries)
+        with stages("polygons"):
+            t_masks = [patch_polygon_mask(self.positions_t[i], boundaries) for i in t_idx]
+            m_masks = [patch_polygon_mask(self.positions_m[i], boundaries) for i in m_idx]
+        return [mask for mask in t_masks if mask.any()], [mask for mask in m_masks if mask.any()]
 
 
 
+def polygon_bboxes(positions):
+    """ Returns a (n_polygons, 4) int array with the row min, row max, col min and col max
+    of every polygon in positions. Max values are included."""
+    if len(positions) == 0:
+        return np.zeros((0, 4), dtype = int)
+    if positions.dtype == object:
+        
+        # polygons with different numbers of corners
+        
+        return np.array([[polygon[:,1].min(), polygon[:,1].max(), polygon[:,0].min(), polygon[:,0].max()]
+                         for polygon in positions], dtype = int)
+    return np.stack([positions[:,:,1].min(axis=1), positions[:,:,1].max(axis=1),
+                     positions[:,:,0].min(axis=1), positions[:,:,0].max(axis=1)], axis=1)
 
 
-def create_database(data_in_path, data_out_path, patch_dimensions, patch_number, inference = False, ovl = 0, save_all = True ):
-    """This function creates a databased of subpatches from the original data.
-    Also generates virtual "edge" channel from the image and can be adapted to generate an arbitrary 
-    number of channels from image modifications. 
-    data_in_path is the path to the original data.
-    data_out_path is where to save the cut images along with their masks.
-    patch_dimensions is a len-2 list with y and x dimensions of each patch. (IP convention)
-    patch_number is the number of patches to be created per image. Only used when inference = False.
-    inference is a flag which tells if subpatches have to be created in order. 
-    If it's false, image is cropped randomly.
-    Overlap was supposed to be used to divide an image for final visualization, but was never used. """
-    if not os.path.exists(data_out_path):
-        os.makedirs(data_out_path)
+
+def bboxes_intersect(bboxes, boundaries):
+    """ Returns a boolean array telling which of the bboxes (as given by polygon_bboxes) touch the window
+    boundaries = [[y1, y2], [x1, x2]], y2 and x2 excluded."""
+    return ((bboxes[:,1] >= boundaries[0][0]) & (bboxes[:,0] < boundaries[0][1]) &
+            (bboxes[:,3] >= boundaries[1][0]) & (bboxes[:,2] < boundaries[1][1]))
+
+
+
+def is_not_empty(positions_t, positions_m, boundaries):
+    """ This function checks if there is any mask in boundaries, used to discard empty patches.
+    Loads tissue masks from positions_t and magnetic masks from positions_m.
+    Returns a flag for each class, true when at least a pixel of one of its polygons is in boundaries.
+    Builds a PolygonIndex at every call, use the index directly when checking many windows."""
+    t_masks, m_masks = PolygonIndex(positions_t, positions_m).patch_masks(boundaries)
+    return len(t_masks) > 0, len(m_masks) > 0
+
+
+
+class PatchSampler:
+    """ Draws random non empty patch windows of an image without rejection loops over the whole image.
+    The window origins whose window touches the bounding box of a polygon are marked, per class, on an
+    occupancy map of cell_size x cell_size origin cells, filled with one 2D cumulative sum (an integral
+    image) of the bounding box rectangles. A cell is drawn with a probability proportional to its number
+    of origins, then an origin in the cell, and the window is checked exactly by rasterizing its polygons.
+    All non empty windows are in marked cells, so windows are drawn uniformly among the non empty ones
+    as by drawing random corners until a window is not empty, but only windows close to polygons are tried.
+    index is the PolygonIndex of the image, shape its (height, width).
+    Raises ValueError when the image has no non empty window."""
+    
+    def __init__(self, index, shape, patch_dimensions, cell_size = 64, max_tries = 1000):
+        self.index = index
+        self.patch_dimensions = patch_dimensions
+        self.cell_size = cell_size
+        self.max_tries = max_tries
         
-    # Random crop mode  
+        # window origins are drawn in [0, height - patch height) x [0, width - patch width)
+        
+        self.n_origins = (shape[0] - patch_dimensions[0], shape[1] - patch_dimensions[1])
+        if self.n_origins[0] <= 0 or self.n_origins[1] <= 0:
+            raise ValueError(f"image of shape {tuple(shape[:2])} is too small for patches of {patch_dimensions}")
+        
+        # number of origins of every cell, smaller for the last row and column
+        
+        cell_rows = np.diff(np.minimum(np.arange(0, self.n_origins[0] + cell_size, cell_size), self.n_origins[0]))
+        cell_cols = np.diff(np.minimum(np.arange(0, self.n_origins[1] + cell_size, cell_size), self.n_origins[1]))
+        self.cell_origins = np.outer(cell_rows, cell_cols)
+        
+        self.cells = {"tissue": self.occupied_cells(index.bboxes_t),
+                      "mag": self.occupied_cells(index.bboxes_m)}
+        self.cells["any"] = np.union1d(self.cells["tissue"], self.cells["mag"])
+        if len(self.cells["any"]) == 0:
+            raise ValueError("image has no polygon inside the possible patch windows")
+        self.weights = {name: np.cumsum(self.cell_origins.ravel()[cells]) for name, cells in self.cells.items()}
     
-    if inference == False:
+    def occupied_cells(self, bboxes):
+        """ Returns the flat indices of the origin cells with at least an origin whose window touches one
+        of the bboxes (as given by polygon_bboxes)."""
         
-        image_list = os.listdir(data_in_path) 
-        image_counter = 0
+        # origins of windows touching a bbox form a rectangle, clipped to the possible origins
         
-        for folder in image_list:
-            
-            print("Processing ", folder)
-            
-            data_path = os.path.join(data_in_path, folder)
-            file_list = os.listdir(data_path)
-            
-            image_files = [x for x in file_list if x.endswith('.tif') ]
-            
-            # channel names
-            
-            ic_image_file = [x for x in image_files if "intensityCorrected" in x ]
-            mf_image_file = [x for x in image_files if "magFluo" in x ]
-            
-            # mask txt files name
-            
-            mag_files = [x for x in file_list if "mag" in x and x.endswith('.txt')] 
-            tissue_files = [x for x in file_list if "tissue" in x and x.endswith('.txt')]
-            
-            # channel/txt final paths
+        lower = np.maximum(bboxes[:, [0, 2]] - np.asarray(self.patch_dimensions) + 1, 0)
+        upper = np.minimum(bboxes[:, [1, 3]], np.asarray(self.n_origins) - 1)
+        inside = (lower <= upper).all(axis = 1)
+        lower = lower[inside] // self.cell_size
+        upper = upper[inside] // self.cell_size + 1
+        
+        # count the rectangles covering every cell with a 2D cumulative sum of their corners
+        
+        occupancy = np.zeros(np.asarray(self.cell_origins.shape) + 1, dtype = int)
+        np.add.at(occupancy, (lower[:, 0], lower[:, 1]), 1)
+        np.add.at(occupancy, (upper[:, 0], lower[:, 1]), -1)
+        np.add.at(occupancy, (lower[:, 0], upper[:, 1]), -1)
+        np.add.at(occupancy, (upper[:, 0], upper[:, 1]), 1)
+        occupancy = occupancy.cumsum(axis = 0).cumsum(axis = 1)[:-1, :-1]
+        return np.flatnonzero(occupancy > 0)
+    
+    def sample(self, rng, class_balance = False, stages = None):
+        """ Returns the boundaries of a random non empty patch and its lists of tissue and mag masks.
+        rng is a numpy random generator. With class_balance, the patch is drawn among the ones with a
+        tissue mask or among the ones with a mag mask with equal probability, instead of among all
+        non empty patches. stages is an optional StageTimer given to PolygonIndex.patch_masks."""
+        name = "any"
+        if class_balance and len(self.cells["tissue"]) > 0 and len(self.cells["mag"]) > 0:
+            name = ["tissue", "mag"][rng.integers(2)]
+        cells = self.cells[name]
+        weights = self.weights[name]
+        
+        for _ in range(self.max_tries):
             
-            ic_image_path = os.path.join(data_path,ic_image_file[0])
-            mf_image_path = os.path.join(data_path,mf_image_file[0])
-            mag_path = os.path.join(data_path,mag_files[0])
-            tissue_path = os.path.join(data_path,tissue_files[0])
+            # draw an origin cell, then an origin in the cell
             
-            # images to be divided
+            cell = cells[np.searchsorted(weights, rng.integers(weights[-1]), side = "right")]
+            cell_row, cell_col = np.unravel_index(cell, self.cell_origins.shape)
+            x1 = cell_row * self.cell_size + rng.integers(min(self.cell_size, self.n_origins[0] - cell_row * self.cell_size))
+            x2 = cell_col * self.cell_size + rng.integers(min(self.cell_size, self.n_origins[1] - cell_col * self.cell_size))
+            boundaries = [[int(x1), int(x1) + self.patch_dimensions[0]], [int(x2), int(x2) + self.patch_dimensions[1]]]
             
-            ic_image = skimage.io.imread(ic_image_path)
-            mf_image = skimage.io.imread(mf_image_path)
-            ic_image_edge = skimage.img_as_ubyte(skimage.filters.sobel(ic_image))
+            # rasterize the polygons touching the patch, the patch is empty if there is no mask
             
-            height, width = ic_image.shape
+            t_masks, m_masks = self.index.patch_masks(boundaries, stages)
+            if {"any": t_masks or m_masks, "tissue": t_masks, "mag": m_masks}[name]:
+                return boundaries, t_masks, m_masks
+        
+        raise ValueError(f"no non empty patch found in {self.max_tries} windows touching polygon bounding boxes")
+
+
+
+SOBEL_SMOOTH = np.array([0.25, 0.5, 0.25])
+SOBEL_EDGE = np.array([1., 0., -1.])
+
+
+
+def edges_window(image, boundaries):
+    """ This function computes the "edge" channel, skimage.img_as_ubyte(skimage.filters.sobel(image)),
+    in the window boundaries only. The filter is applied on the window with a one pixel halo (reflected
+    at the image borders as skimage does), so windows give the same values as the whole image filter
+    and memory depends on the window size only.
+    For uint8 images the filter is computed with integers: the gradients of the 8 bit values are exact
+    and the ubyte edge value is the rounded sqrt(S / 32), S being the sum of their squares.
+    Rounding is decided by float errors of skimage where sqrt(S / 32) is exactly an half integer,
+    these few pixels are computed with the float operations of skimage (see sobel_ubyte_ties)."""
+    r1 = max(boundaries[0][0] - 1, 0)
+    r2 = min(boundaries[0][1] + 1, image.shape[0])
+    c1 = max(boundaries[1][0] - 1, 0)
+    c2 = min(boundaries[1][1] + 1, image.shape[1])
+    region = np.asarray(image[r1:r2, c1:c2])
+    
+    if region.dtype != np.uint8:
+        edges = skimage.img_as_ubyte(skimage.filters.sobel(region))
+        return edges[boundaries[0][0] - r1 : boundaries[0][1] - r1, boundaries[1][0] - c1 : boundaries[1][1] - c1]
+    
+    # halo reflected where the window touches the image borders
+    
+    pad = ((1 - (boundaries[0][0] - r1), 1 - (r2 - boundaries[0][1])),
+           (1 - (boundaries[1][0] - c1), 1 - (c2 - boundaries[1][1])))
+    padded = np.pad(region, pad, mode = "symmetric").astype(np.int32)
+    
+    # 8 bit gradients along both axes, 4 * 255 times the float ones of skimage
+    
+    smooth_x = padded[:, :-2] + 2 * padded[:, 1:-1] + padded[:, 2:]
+    smooth_y = padded[:-2, :] + 2 * padded[1:-1, :] + padded[2:, :]
+    gradients = (smooth_x[:-2, :] - smooth_x[2:, :]) ** 2 + (smooth_y[:, :-2] - smooth_y[:, 2:]) ** 2
+    
+    # S / 32 is exact in float32, its sqrt is far enough from half integers except for exact ties
+    
+    edges = np.rint(np.sqrt(gradients.astype(np.float32) / 32)).astype(np.uint8)
+    
+    # ties are S = 8 * n ** 2 with n odd
+    
+    n = np.rint(np.sqrt(gradients // 8)).astype(np.int32)
+    ties = np.nonzero((gradients % 8 == 0) & (n * n == gradients // 8) & (n % 2 == 1))
+    if len(ties[0]) > 0:
+        edges[ties] = sobel_ubyte_ties(padded, ties)
+    
+    return edges
+
+
+
+def sobel_ubyte_ties(padded, pixels):
+    """ Computes img_as_ubyte(sobel(image)) at the given pixels with the float operations of skimage,
+    in the same order, so that rounding of half integer values is identical.
+    padded is the window with a one pixel halo, pixels the (rows, cols) indices in the window."""
+    rows, cols = pixels
+    magnitude = np.zeros(len(rows))
+    
+    # ndimage.convolve flips the kernel and accumulates its non zero weights in C order
+    
+    for kernel in [SOBEL_EDGE[:, np.newaxis] * SOBEL_SMOOTH, SOBEL_SMOOTH[:, np.newaxis] * SOBEL_EDGE]:
+        flipped = kernel[::-1, ::-1]
+        gradient = np.zeros(len(rows))
+        for i in range(3):
+            for j in range(3):
+                if flipped[i, j] != 0:
+                    gradient += skimage.img_as_float(padded[rows + i, cols + j].astype(np.uint8)) * flipped[i, j]
+        gradient *= gradient
+        magnitude += gradient
+    magnitude = np.sqrt(magnitude) / np.sqrt(2)
+    
+    return skimage.img_as_ubyte(magnitude)
+
+
+
+def patch_polygon_mask(polygon, boundaries):
+    """ This function rasterizes one polygon inside the patch window given by boundaries.
+    polygon is a (n_corners, 2) array of x, y corners as returned by import_txt.
+    Returns a uint8 mask of the window with 255 inside the polygon. Only the window is allocated, so the
+    cost depends on the patch size and not on the size of the whole image."""
+    rows = polygon[:,1]
+    cols = polygon[:,0]
+    
+    # shift the polygon to window coordinates, pixels outside the window are clipped by shape
+    
+    shape = (boundaries[0][1] - boundaries[0][0], boundaries[1][1] - boundaries[1][0])
+    patch_mask = np.zeros(shape, dtype = np.uint8)
+    pixels = skimage.draw.polygon(rows - boundaries[0][0], cols - boundaries[1][0], shape = shape)
+    patch_mask[pixels] = 255
+    
+    return patch_mask
+
+
+
+def save_masks(masks, mask_path, name):
+    """ This function saves the given patch masks in mask_path as {name}_mask_{k}.tif."""
+    for k in range(len(masks)):
+        mask_save_path = os.path.join(mask_path,f"{name}_mask_{k}.tif")
+        skimage.io.imsave(mask_save_path, masks[k])
+
+
+
+LABEL_CLASSES = [{"file": "mag_labels.tif", "class_id": 2, "name": "mag"},
+                 {"file": "tissue_labels.tif", "class_id": 1, "name": "tissue"}]
+
+
+
+class TiffPatchWriter:
+    """ Writes the patches of one image in the tiff directory layout:
+    image_path/patch_name/images/{file_name}_{channel}.tif for every channel and, depending on mask_format,
+    "instances": image_path/patch_name/tissue(mag)/tissue(mag)_mask_{k}.tif for every instance, or
+    "labels": image_path/patch_name/labels/tissue(mag)_labels.tif, one uint16 instance label image per class
+    (0 background, instance k labelled k + 1), with the class of each file in image_path/classes.json.
+    The number of instances of a label tif is saved in its description, as {"instances": n}.
+    Label images can not hold overlapping instances: patches with overlapping instances of a class are
+    saved in the "instances" layout, with a warning. Readers check the layout of every patch."""
+    
+    def __init__(self, image_path, mask_format = "instances"):
+        self.image_path = image_path
+        self.mask_format = mask_format
+        if not os.path.exists(image_path):
+            os.makedirs(image_path)
+        if mask_format == "labels":
+            with open(os.path.join(image_path, "classes.json"), "w") as f:
+                json.dump(LABEL_CLASSES, f)
+    
+    def write_patch(self, patch_name, file_name, channels, t_masks, m_masks):
+        """ Saves a patch. channels is a dict of channel name to image.
+        t_masks and m_masks are the lists of tissue and mag instance masks of the patch."""
+        patch_path = os.path.join(self.image_path, patch_name)
+        
+        # save channels
+        
+        patch_image_path = os.path.join(patch_path,"images")
+        if not os.path.exists(patch_image_path):
+            os.makedirs(patch_image_path)
+        
+        for channel in channels:
+            channel_save_path = os.path.join(patch_image_path,f"{file_name}_{channel}.tif")
+            skimage.io.imsave(channel_save_path, channels[channel])
+        
+        # overlapping instances would lose pixels in a label image
+        
+        overlap = self.mask_format == "labels" and (packed.masks_overlap(t_masks) or packed.masks_overlap(m_masks))
+        if overlap:
+            logger.warning("%s: overlapping instances in patch %s, saved as one tif per instance",
+                           self.image_path, patch_name)
+        
+        if self.mask_format == "labels" and not overlap:
+            label_path = os.path.join(patch_path,"labels")
+            if not os.path.exists(label_path):
+                os.makedirs(label_path)
+            shape = next(iter(channels.values())).shape
+            for name, masks in [("tissue", t_masks), ("mag", m_masks)]:
+                labels = packed.label_image(masks, shape)
+                tifffile.imwrite(os.path.join(label_path, f"{name}_labels.tif"), labels,
+                                 metadata = {"instances": packed.count_labels(labels)})
+            return
+        
+        # paths for saving masks
+        
+        mag_mask_path = os.path.join(patch_path,"mag")
+        tissue_mask_path = os.path.join(patch_path,"tissue")
+        if not os.path.exists(mag_mask_path):
+            os.makedirs(mag_mask_path)
+        if not os.path.exists(tissue_mask_path):
+            os.makedirs(tissue_mask_path)
+        
+        # save masks of subpatch
+        
+        save_masks(t_masks, tissue_mask_path, "tissue")
+        save_masks(m_masks, mag_mask_path, "mag")
+    
+    def checkpoint(self):
+        """ Nothing to flush in the tiff layout, every patch is saved by write_patch."""
+        pass
+    
+    def close(self):
+        """ Nothing to finalize in the tiff layout."""
+        pass
+
+
+
+def find_image_files(data_path):
+    """ This function finds the files of one image folder of the original data.
+    Returns the paths of the intensity corrected and magFluo channels and of the tissue and mag txt files."""
+    file_list = os.listdir(data_path)
+    
+    # channel names
+    
+    image_files = [x for x in file_list if x.endswith('.tif') ]
+    ic_image_file = [x for x in image_files if "intensityCorrected" in x ]
+    mf_image_file = [x for x in image_files if "magFluo" in x ]
+    
+    # mask txt files name
+    
+    mag_files = [x for x in file_list if "mag" in x and x.endswith('.txt')] 
+    tissue_files = [x for x in file_list if "tissue" in x and x.endswith('.txt')]
+    
+    # channel/txt final paths
+    
+    ic_image_path = os.path.join(data_path,ic_image_file[0])
+    mf_image_path = os.path.join(data_path,mf_image_file[0])
+    mag_path = os.path.join(data_path,mag_files[0])
+    tissue_path = os.path.join(data_path,tissue_files[0])
+    
+    return ic_image_path, mf_image_path, tissue_path, mag_path
+
+
+
+class StageTimer:
+    """ Wall time and number of calls of the stages of a build, e.g. of create_image_patches:
+    
+        with stages("write"):
+            writer.write_patch(...)
+    
+    Stages can be nested, the time of a stage excludes the time of the stages run inside it.
+    A disabled timer (NO_STAGES) records nothing and only costs a method call per stage."""
+    
+    def __init__(self, enabled = True):
+        self.enabled = enabled
+        self.seconds = {}
+        self.calls = {}
+        self.start = time.perf_counter()
+        self._running = []
+    
+    def __call__(self, name):
+        if not self.enabled:
+            return NULL_STAGE
+        return _Stage(self, name)
+    
+    def summary(self):
+        """ Returns the seconds and calls of every stage and the total wall time since the timer was
+        created, as a json serializable dict."""
+        return {"stages": {name: {"seconds": self.seconds[name], "calls": self.calls[name]}
+                           for name in self.seconds},
+                "total_seconds": time.perf_counter() - self.start}
+
+
+
+class _Stage:
+    """ Context of one call of a stage of a StageTimer."""
+    
+    __slots__ = ("timer", "name", "start", "inner")
+    
+    def __init__(self, timer, name):
+        self.timer = timer
+        self.name = name
+    
+    def __enter__(self):
+        self.timer._running.append(self)
+        self.inner = 0.
+        self.start = time.perf_counter()
+    
+    def __exit__(self, *exc_info):
+        elapsed = time.perf_counter() - self.start
+        timer = self.timer
+        timer._running.pop()
+        timer.seconds[self.name] = timer.seconds.get(self.name, 0.) + elapsed - self.inner
+        timer.calls[self.name] = timer.calls.get(self.name, 0) + 1
+        if timer._running:
+            timer._running[-1].inner += elapsed
+        return False
+
+
+
+NULL_STAGE = contextlib.nullcontext()
+NO_STAGES = StageTimer(enabled = False)
+
+
+
+def peak_rss():
+    """ Returns the peak resident memory in bytes of this process and of its largest finished child
+    process, None where the resource module is not available.
+    Peaks are over the whole life of the process, e.g. of a create_database worker over all its images,
+    see reset_peak_rss for the peak of a part of it."""
+    if resource is None:
+        return None
+    
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    
+    scale = 1 if sys.platform == "darwin" else 1024
+    return {"self": max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale, _peak_rss_before_reset),
+            "children": resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * scale}
+
+
+
+# peak resident memory of this process before the last reset_peak_rss
+
+_peak_rss_before_reset = 0
+
+
+def _high_water_rss():
+    # peak resident memory of this process since its start or the last reset, None without /proc/self
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+
+def reset_peak_rss():
+    """ Starts measuring the peak resident memory of this process again, e.g. for every image of a
+    create_database worker, read by peak_rss_since_reset. peak_rss still returns the peak of the whole
+    life of the process. Returns False where it is not supported (only Linux is)."""
+    global _peak_rss_before_reset
+    high_water = _high_water_rss()
+    if high_water is None:
+        return False
+    _peak_rss_before_reset = max(_peak_rss_before_reset, high_water)
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except OSError:
+        return False
+    return True
+
+
+
+def peak_rss_since_reset():
+    """ Returns the peak resident memory in bytes of this process since the last reset_peak_rss."""
+    return _high_water_rss()
+
+
+
+STATISTICS_FILE = "statistics.json"
+PATCH_STATISTICS_FILE = "patch_statistics.json"
+
+
+
+class ChannelStatistics:
+    """ Streaming statistics of the 8 bit channels of the patches of a database: per channel the number
+    of pixels, their sum, the sum of their squares and their 256 bins histogram, from which the mean,
+    the standard deviation and quantiles follow. Sums are exact python integers, so statistics of
+    several images can be merged in any order."""
+    
+    def __init__(self, statistics = None):
+        """ statistics is a dict saved by to_dict, None for empty statistics."""
+        self.channels = {}
+        for name, channel in (statistics or {}).items():
+            self.channels[name] = {"count": channel["count"], "sum": channel["sum"], "sumsq": channel["sumsq"],
+                                   "histogram": np.asarray(channel["histogram"], dtype = np.int64)}
+    
+    def update(self, channels):
+        """ Adds a patch, channels is a dict of channel name to image, converted to 8 bit as by load_image.
+        Returns the [count, sum] of every channel of the patch."""
+        patch = {}
+        for name, image in channels.items():
+            histogram = np.bincount(skimage.img_as_ubyte(image).ravel(), minlength = 256)
+            if name not in self.channels:
+                self.channels[name] = {"count": 0, "sum": 0, "sumsq": 0, "histogram": np.zeros(256, dtype = np.int64)}
+            channel = self.channels[name]
+            channel["count"] += int(histogram.sum())
+            channel["sum"] += int(histogram @ np.arange(256))
+            channel["sumsq"] += int(histogram @ np.arange(256)**2)
+            channel["histogram"] += histogram
+            patch[name] = [int(histogram.sum()), int(histogram @ np.arange(256))]
+        return patch
+    
+    def merge(self, other):
+        """ Adds the statistics of other, e.g. of another image."""
+        for name, channel in other.channels.items():
+            if name not in self.channels:
+                self.channels[name] = {"count": 0, "sum": 0, "sumsq": 0, "histogram": np.zeros(256, dtype = np.int64)}
+            for key in channel:
+                self.channels[name][key] = self.channels[name][key] + channel[key]
+        return self
+    
+    def covers(self, channels):
+        """ Checks if the statistics of every channel of the list are known, "none" channels always are."""
+        return all(name == "none" or name in self.channels for name in channels)
+    
+    def mean(self, channels = None):
+        """ Returns the mean of the given list of channels, all if None. "none" channels have mean 0."""
+        names = list(self.channels) if channels is None else channels
+        return np.array([self.channels[name]["sum"] / self.channels[name]["count"] if name != "none" else 0.
+                         for name in names])
+    
+    def std(self, channels = None):
+        """ Returns the standard deviation of the given list of channels, all if None."""
+        names = list(self.channels) if channels is None else channels
+        mean = self.mean(names)
+        return np.array([np.sqrt(max(self.channels[name]["sumsq"] / self.channels[name]["count"] - mean[k]**2, 0.))
+                         if name != "none" else 0. for k, name in enumerate(names)])
+    
+    def to_dict(self):
+        """ Returns the statistics as a json serializable dict, with the mean and std of every channel."""
+        return {name: {"count": channel["count"], "sum": channel["sum"], "sumsq": channel["sumsq"],
+                       "mean": float(self.mean([name])[0]), "std": float(self.std([name])[0]),
+                       "histogram": channel["histogram"].tolist()}
+                for name, channel in self.channels.items()}
+
+
+
+def load_statistics(dataset_dir, image_names = None):
+    """ Returns the ChannelStatistics of the images of a database saved by create_database, i.e. of the
+    image directories in dataset_dir, or only of the given image_names. Returns None if there is no image
+    or if the statistics of an image are missing (databases created before they were saved)."""
+    if image_names is None:
+        image_names = sorted(x for x in os.listdir(dataset_dir) if os.path.isdir(os.path.join(dataset_dir, x)))
+    if not image_names:
+        return None
+    statistics = ChannelStatistics()
+    for image_name in image_names:
+        statistics_path = os.path.join(dataset_dir, image_name, STATISTICS_FILE)
+        if not os.path.exists(statistics_path):
+            return None
+        with open(statistics_path) as f:
+            statistics.merge(ChannelStatistics(json.load(f)))
+    return statistics
+
+
+
+def load_pixel_sums(dataset_dir, patches):
+    """ Returns the number of pixels and the sum of every channel, as a dict of channel name to [count, sum],
+    of the given patches of a database saved by create_database. patches is a dict of image name to the list
+    of names of its patches. Returns None if the sums of a patch are missing (databases created before they
+    were saved)."""
+    sums = {}
+    for image_name, patch_names in patches.items():
+        patch_statistics_path = os.path.join(dataset_dir, image_name, PATCH_STATISTICS_FILE)
+        if not os.path.exists(patch_statistics_path):
+            return None
+        with open(patch_statistics_path) as f:
+            patch_statistics = json.load(f)
+        for patch_name in patch_names:
+            if patch_name not in patch_statistics:
+                return None
+            for name, (count, total) in patch_statistics[patch_name].items():
+                channel = sums.setdefault(name, [0, 0])
+                channel[0] += count
+                channel[1] += total
+    return sums
+
+
+
+MANIFEST_FILE = "manifest.json"
+MANIFEST_CHECKPOINT = 10 # patches written between two saves of the image manifest
+
+
+
+def load_manifest(path):
+    """ Loads the json manifest in path, None if there is none."""
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+
+
+def save_manifest(path, manifest):
+    """ Saves a json manifest in path. The file is replaced at once, so an interrupted save keeps the old one."""
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(manifest, f)
+    os.replace(tmp_path, path)
+
+
+
+def input_signature(paths):
+    """ Returns the size and modification time of every file in paths, used to detect changed inputs."""
+    signature = {}
+    for path in paths:
+        stat = os.stat(path)
+        signature[os.path.basename(path)] = [stat.st_size, stat.st_mtime_ns]
+    return signature
+
+
+
+def create_image_patches(data_path, image_path, patch_dimensions, patch_number, inference = False, ovl = 0,
+                         save_all = True, seed = None, output_format = "tiff", mask_format = "instances",
+                         class_balance = False, stages = None):
+    """This function creates the subpatches of one image folder of the original data.
+    data_path is the folder of the image, image_path is where to save its patches.
+    seed is the seed of the random generator used for random crops, None for a random seed.
+    Other parameters are the ones of create_database. Returns the number of saved patches.
+    Progress is saved in image_path/manifest.json with the input files signature and the parameters.
+    When they did not change, a complete image is skipped and a partial one is continued,
+    otherwise the image is created again from scratch.
+    Channel statistics of the saved patches (see ChannelStatistics) are saved in image_path/statistics.json,
+    the pixel count and sum of every channel of each patch in image_path/patch_statistics.json.
+    stages is an optional StageTimer recording the time spent to decode the channels, compute the edges,
+    parse and rasterize the polygons, check the emptiness of the patches and write them."""
+    
+    stages = stages or NO_STAGES
+    ic_image_path, mf_image_path, tissue_path, mag_path = find_image_files(data_path)
+    
+    # compare with the manifest of a previous run
+    
+    seed = seed if isinstance(seed, np.random.SeedSequence) else np.random.SeedSequence(seed)
+    manifest_path = os.path.join(image_path, MANIFEST_FILE)
+    manifest = {"source": os.path.basename(data_path),
+                "inputs": input_signature([ic_image_path, mf_image_path, tissue_path, mag_path]),
+                "parameters": {"patch_dimensions": list(patch_dimensions), "inference": inference,
+                               "output_format": output_format},
+                "patches": [],
+                "patch_statistics": {},
+                "complete": False}
+    
+    # only the parameters used by the mode and format are recorded
+    
+    if output_format == "tiff":
+        manifest["parameters"].update(mask_format = mask_format)
+    if inference:
+        manifest["parameters"].update(ovl = ovl, save_all = save_all, tiling = "even")
+    else:
+        manifest["parameters"].update(patch_number = patch_number, seed = [seed.entropy, list(seed.spawn_key)],
+                                      class_balance = class_balance)
+    
+    previous = load_manifest(manifest_path)
+    if (previous is not None and previous["inputs"] == manifest["inputs"]
+            and previous["parameters"] == manifest["parameters"]):
+        if previous["complete"]:
+            logger.info("%s: up to date", os.path.basename(data_path))
+            return len(previous["patches"])
+        manifest["patches"] = previous["patches"]
+        manifest["statistics"] = previous.get("statistics", {})
+        manifest["patch_statistics"] = previous.get("patch_statistics", {})
+        logger.info("%s: resuming after %d patches", os.path.basename(data_path), len(manifest["patches"]))
+    else:
+        if os.path.exists(image_path):
+            shutil.rmtree(image_path)
+        logger.info("%s: processing", os.path.basename(data_path))
+    
+    done = set(manifest["patches"])
+    
+    # channel statistics of the written patches, saved with them in the manifest
+    
+    statistics = ChannelStatistics(manifest.get("statistics"))
+    
+    # images to be divided, read by windows
+    
+    with stages("decode"):
+        wafer = wafer_image.WaferImage([ic_image_path, mf_image_path], ["base", "mf"])
+    
+    height, width = wafer.shape[:2]
+    
+    # arrays with mask corners
+    
+    with stages("polygons"):
+        positions_t = import_txt(tissue_path)
+        positions_m = import_txt(mag_path)
+        index = PolygonIndex(positions_t, positions_m)
+    
+    # writer of the patches of the image, creates its directory
+    
+    if output_format == "packed":
+        writer = packed.PackedImageWriter(image_path, ["base", "mf", "edges"], patch_dimensions,
+                                          resume = len(manifest["patches"]))
+    else:
+        writer = TiffPatchWriter(image_path, mask_format)
+    
+    def add_patch(patch_name, channels):
+        # record a written patch, the manifest is saved after the writer has flushed its patches
+        with stages("statistics"):
+            manifest["patch_statistics"][patch_name] = statistics.update(channels)
+        manifest["patches"].append(patch_name)
+        if len(manifest["patches"]) % MANIFEST_CHECKPOINT == 0:
+            manifest["statistics"] = statistics.to_dict()
+            with stages("write"):
+                writer.checkpoint()
+                save_manifest(manifest_path, manifest)
+    
+    def patch_channels(boundaries):
+        # slice channels, the edge channel is computed on the patch only
+        with stages("decode"):
+            patch_base, patch_mf = np.moveaxis(wafer.read_window(boundaries), 2, 0)
+        with stages("sobel"):
+            patch_edges = edges_window(wafer.channel("base"), boundaries)
+        return {"base": patch_base, "mf": patch_mf, "edges": patch_edges}
+    
+    saved_patches = 0
+    
+    # Random crop mode  
+    
+    if inference == False:
+        
+        rng = np.random.default_rng(seed)
+        with stages("polygons"):
+            sampler = PatchSampler(index, (height, width), patch_dimensions)
+        patch_counter = 0
+                
+        while (patch_counter < patch_number):
             
-            # arrays with mask corners
+            # draw a non empty patch
             
-            positions_t = import_txt(tissue_path)
-            positions_m = import_txt(mag_path)
-            patch_counter = 0
+            with stages("emptiness"):
+                boundaries, t_masks, m_masks = sampler.sample(rng, class_balance, stages)
             
-            # create directory to save results for image
+            # patches written by a previous run are skipped, the generator gives the same windows
             
-            image_path = os.path.join(data_out_path,f"image_{image_counter}")
-            if not os.path.exists(image_path):
-                    os.makedirs(image_path)
-                    
-            while (patch_counter < patch_number):
-                patch_path = os.path.join(image_path,f"patch_{patch_counter}")
-                
-                # throw random corner coordinates
-                
-                x1 = np.random.randint(0, height-patch_dimensions[0])
-                x2 = np.random.randint(0, width-patch_dimensions[1])
-                
-                # slice channels, save boundaries
-                
-                patch_base = ic_image[x1:x1+patch_dimensions[0],x2:x2+patch_dimensions[1]]
-                patch_mf = mf_image[x1:x1+patch_dimensions[0],x2:x2+patch_dimensions[1]]
-                patch_edges = ic_image_edge[x1:x1+patch_dimensions[0],x2:x2+patch_dimensions[1]]
-                
-                boundaries = [[x1,x1+patch_dimensions[0]], [x2,x2+patch_dimensions[1]]]
-                
-                # check if the patch is not empty
-                
-                tflag, mflag = is_not_empty(positions_t, positions_m, boundaries)
-                
-                if tflag or mflag:
-                    
-                    # save channels
-                    
-                    if not os.path.exists(patch_path):
-                        os.makedirs(patch_path)
-                    patch_image_path = os.path.join(patch_path,"images")
-                    if not os.path.exists(patch_image_path):
-                        os.makedirs(patch_image_path)
-                        
-                    patch_base_save_path = os.path.join(patch_image_path,f"patch_{patch_counter}_base.tif")
-                    patch_mf_save_path = os.path.join(patch_image_path,f"patch_{patch_counter}_mf.tif")
-                    patch_edges_save_path = os.path.join(patch_image_path,f"patch_{patch_counter}_edges.tif")
-                    
-                    skimage.io.imsave(patch_base_save_path, patch_base)
-                    skimage.io.imsave(patch_mf_save_path, patch_mf)
-                    skimage.io.imsave(patch_edges_save_path, patch_edges)
+            if f"patch_{patch_counter}" not in done:
+                channels = patch_channels(boundaries)
+                with stages("write"):
+                    writer.write_patch(f"patch_{patch_counter}", f"patch_{patch_counter}", channels, t_masks, m_masks)
+                add_patch(f"patch_{patch_counter}", channels)
                     
-                    t_mask_counter = 0
-                    m_mask_counter = 0
-                    
-                    # paths for saving masks
-                    
-                    mag_mask_path = os.path.join(patch_path,"mag")
-                    tissue_mask_path = os.path.join(patch_path,"tissue")
-                    if not os.path.exists(mag_mask_path):
-                        os.makedirs(mag_mask_path)
-                    if not os.path.exists(tissue_mask_path):
-                        os.makedirs(tissue_mask_path)
-                    
-                    # create masks for subpatch from corner positions and save them
-                    
-                    for i in range(len(positions_t)):
-                        
-                        t_label_mask = np.zeros( (ic_image.shape[0], ic_image.shape[1]) ).astype(np.uint8)
-                        t_pixels = skimage.draw.polygon(positions_t[i,:,1], positions_t[i,:,0])
-                        skimage.draw.set_color(t_label_mask, t_pixels, 255)
-                        
-                        t_mask_save_path = os.path.join(tissue_mask_path,f"tissue_mask_{t_mask_counter}.tif")
-                        t_patch_mask = t_label_mask[ boundaries[0][0]:boundaries[0][1], boundaries[1][0]:boundaries[1][1] ]
-                        #check if mask is not empty and save
-                        
-                        if t_patch_mask.any():
-                            skimage.io.imsave(t_mask_save_path,t_patch_mask)
-                            t_mask_counter = t_mask_counter + 1
-                    
-                    for i in range(len(positions_m)):
-                        m_label_mask = np.zeros( (ic_image.shape[0], ic_image.shape[1]) ).astype(np.uint8)
-                        m_pixels = skimage.draw.polygon(positions_m[i,:,1], positions_m[i,:,0])
-                        skimage.draw.set_color(m_label_mask, m_pixels, 255)
-                        m_mask_save_path = os.path.join(mag_mask_path,f"mag_mask_{m_mask_counter}.tif")
-                        m_patch_mask = m_label_mask[ boundaries[0][0]:boundaries[0][1], boundaries[1][0]:boundaries[1][1] ]
-                        #check if mask is not empty and save
-                        
-                        if m_patch_mask.any():
-                            skimage.io.imsave(m_mask_save_path,m_patch_mask)
-                            m_mask_counter = m_mask_counter + 1
-                            
-                    patch_counter = patch_counter + 1
-            image_counter = image_counter + 1 
+            patch_counter = patch_counter + 1
+        
+        saved_patches = patch_counter
+    
     # ordered patch mode
     
     if inference == True:
         
-        image_list = os.listdir(data_in_path) 
-        image_counter = 0
+        # patches are the tiles of the grid shared with whole_image.model_confl
         
-        for folder in image_list:
-            
-            print("Processing ", folder)
-            data_path = os.path.join(data_in_path, folder)
-            
-            file_list = os.listdir(data_path)
-            
-            #channel names
-            
-            image_files = [x for x in file_list if x.endswith('.tif') ]
-            ic_image_file = [x for x in image_files if "intensityCorrected" in x ]
-            mf_image_file = [x for x in image_files if "magFluo" in x ]
-            
-            #.txt file names
-            
-            mag_files = [x for x in file_list if "mag" in x and x.endswith('.txt')] 
-            tissue_files = [x for x in file_list if "tissue" in x and x.endswith('.txt')]
-            
-            # final paths
-            
-            ic_image_path = os.path.join(data_path,ic_image_file[0])
-            mf_image_path = os.path.join(data_path,mf_image_file[0])
-            mag_path = os.path.join(data_path,mag_files[0])
-            tissue_path = os.path.join(data_path,tissue_files[0])
-            
-            # channels
-            
-            ic_image = skimage.io.imread(ic_image_path)
-            mf_image = skimage.io.imread(mf_image_path)
-            ic_image_edge = skimage.img_as_ubyte(skimage.filters.sobel(ic_image))
+        for patch_counter, tile in enumerate(tiling.tile_grid((height, width), patch_dimensions, ovl)):
             
-            height, width = ic_image.shape
+            boundaries = tiling.tile_boundaries(tile)
+            patch_name = f"patch_{tile.index[0]}_{tile.index[1]}"
             
-            # import mask corners from .txt
+            # rasterize the polygons touching the patch, the patch is empty if there is no mask
             
-            positions_t = import_txt(tissue_path)
-            positions_m = import_txt(mag_path)
+            with stages("emptiness"):
+                t_masks, m_masks = index.patch_masks(boundaries, stages)
             
-            # create image folder
-            
-            image_path = os.path.join(data_out_path,f"image_{image_counter}")
-            if not os.path.exists(image_path):
-                    os.makedirs(image_path)
-            
-            # initialize counters for cycling over whole image.
-            patch_counter = 0
-            counter_x1 = 0
-            counter_x2 = 0
-            limit_x1 = False # has reached end of dimension 1?
-            limit_x2 = False # has reached end of dimension 2?
+            if t_masks or m_masks or save_all:
+                
+                if patch_name not in done:
+                    channels = patch_channels(boundaries)
+                    with stages("write"):
+                        writer.write_patch(patch_name, f"patch_{patch_counter}", channels, t_masks, m_masks)
+                    add_patch(patch_name, channels)
+                
+                saved_patches = saved_patches + 1
+    
+    manifest["statistics"] = statistics.to_dict()
+    with stages("write"):
+        writer.close()
+        with open(os.path.join(image_path, STATISTICS_FILE), "w") as f:
+            json.dump(manifest["statistics"], f)
+        with open(os.path.join(image_path, PATCH_STATISTICS_FILE), "w") as f:
+            json.dump(manifest["patch_statistics"], f)
+        manifest["complete"] = True
+        save_manifest(manifest_path, manifest)
+    
+    return saved_patches
 
-            while(limit_x1 == False):
 
-                limit_x2 = False
-                while(limit_x2 == False):
 
-                    # patch coordinates. adjusted when outside image boundaries.
-                    
-                    start_x2 = patch_dimensions[1]*counter_x2 - ovl*counter_x2
-                    if start_x2 < 0:
-                        start_x2 = 0
-
-                    start_x1 = patch_dimensions[0]*counter_x1 - ovl*counter_x1
-                    if start_x1 < 0:
-                        start_x1 = 0
-
-                    end_x2 = start_x2 + patch_dimensions[1]
-                    if start_x2 + patch_dimensions[1] > width:
-                        end_x2 = width
-                        start_x2 = width - patch_dimensions[1]
-
-                    end_x1 = start_x1 + patch_dimensions[0]
-                    if start_x1 + patch_dimensions[0] > height:
-                        end_x1 = height
-                        start_x1 = height - patch_dimensions[0]
-
-                        
-                    # patch channels
-                    
-                    patch_base = ic_image[start_x1:end_x1,start_x2:end_x2]
-                    patch_mf = mf_image[start_x1:end_x1,start_x2:end_x2]
-                    patch_edges = ic_image_edge[start_x1:end_x1,start_x2:end_x2]
-                    
-                    boundaries = [[start_x1 , end_x1], [start_x2 , end_x2]]
-                    
-                    #check if patch is not empty
-                    
-                    tflag, mflag = is_not_empty(positions_t, positions_m, boundaries)
-
-                    if tflag or mflag or save_all:
-                        
-                        # save channels
-                        
-                        patch_path = os.path.join(image_path,f"patch_{counter_x1}_{counter_x2}")
-                        
-                        if not os.path.exists(patch_path):
-                            os.makedirs(patch_path)
-
-                        patch_image_path = os.path.join(patch_path,"images")
-                        
-                        if not os.path.exists(patch_image_path):
-                            os.makedirs(patch_image_path)
-                        
-                        patch_base_save_path = os.path.join(patch_image_path,f"patch_{patch_counter}_base.tif")
-                        patch_mf_save_path = os.path.join(patch_image_path,f"patch_{patch_counter}_mf.tif")
-                        patch_edges_save_path = os.path.join(patch_image_path,f"patch_{patch_counter}_edges.tif")
-
-                        skimage.io.imsave(patch_base_save_path, patch_base)
-                        skimage.io.imsave(patch_mf_save_path, patch_mf)
-                        skimage.io.imsave(patch_edges_save_path, patch_edges)
-
-                        t_mask_counter = 0
-                        m_mask_counter = 0
-                           
-                        # path for masks
-                        
-                        mag_mask_path = os.path.join(patch_path,"mag")
-                        tissue_mask_path = os.path.join(patch_path,"tissue")
-                        
-                        if not os.path.exists(mag_mask_path):
-                            os.makedirs(mag_mask_path)
-                        if not os.path.exists(tissue_mask_path):
-                            os.makedirs(tissue_mask_path)
-                            
-                        # save masks    
-                            
-                        for i in range(len(positions_t)):
-                            
-                            t_label_mask = np.zeros( (ic_image.shape[0], ic_image.shape[1]) ).astype(np.uint8)
-                            t_pixels = skimage.draw.polygon(positions_t[i,:,1], positions_t[i,:,0])
-                            skimage.draw.set_color(t_label_mask, t_pixels, 255)
-                            
-                            t_mask_save_path = os.path.join(tissue_mask_path,f"tissue_mask_{t_mask_counter}.tif")
-                            t_patch_mask = t_label_mask[ boundaries[0][0]:boundaries[0][1], boundaries[1][0]:boundaries[1][1] ]
-                            # check if mask is not empty and save it
-                            
-                            if t_patch_mask.any():
-                                skimage.io.imsave(t_mask_save_path,t_patch_mask)
-                                t_mask_counter = t_mask_counter + 1
-                        
-                        for i in range(len(positions_m)):
-                            
-                            m_label_mask = np.zeros( (ic_image.shape[0], ic_image.shape[1]) ).astype(np.uint8)
-                            m_pixels = skimage.draw.polygon(positions_m[i,:,1], positions_m[i,:,0])
-                            skimage.draw.set_color(m_label_mask, m_pixels, 255)
-                            
-                            m_mask_save_path = os.path.join(mag_mask_path,f"mag_mask_{m_mask_counter}.tif")
-                            m_patch_mask = m_label_mask[ boundaries[0][0]:boundaries[0][1], boundaries[1][0]:boundaries[1][1] ]
-                            
-                            # check if mask is not empty and save it
-                            
-                            if m_patch_mask.any():
-                                skimage.io.imsave(m_mask_save_path,m_patch_mask)
-                                m_mask_counter = m_mask_counter + 1
-                    
-                    patch_counter = patch_counter + 1
-                    counter_x2 = counter_x2 + 1
+def _create_image_patches_job(job):
+    """ Unpacks the arguments of create_image_patches for the process pool of create_database.
+    Returns the number of saved patches and the summary of the stages, None when not profiled.
+    When profiled, the summary also has the peak resident memory of the process while the image was
+    processed (image_peak_rss), None where it can not be measured (see reset_peak_rss)."""
+    stages = StageTimer(job.pop("profile"))
+    measured = stages.enabled and reset_peak_rss()
+    saved_patches = create_image_patches(stages = stages, **job)
+    if not stages.enabled:
+        return saved_patches, None
+    summary = stages.summary()
+    summary["image_peak_rss"] = peak_rss_since_reset() if measured else None
+    return saved_patches, summary
 
-                    if end_x2 == width:
-                        counter_x2 = 0
-                        limit_x2 = True
-                        counter_x1 = counter_x1 + 1
 
-                if limit_x2 == True and end_x1 == height:
-                    limit_x1 = True
 
-            image_counter = image_counter + 1             
+def create_database(data_in_path, data_out_path, patch_dimensions, patch_number, inference = False, ovl = 0, save_all = True,
+                    workers = 1, seed = None, output_format = "tiff", mask_format = "instances", class_balance = False,
+                    profile = False):
+    """This function creates a databased of subpatches from the original data.
+    Also generates virtual "edge" channel from the image and can be adapted to generate an arbitrary 
+    number of channels from image modifications. 
+    data_in_path is the path to the original data.
+    data_out_path is where to save the cut images along with their masks.
+    patch_dimensions is a len-2 list with y and x dimensions of each patch. (IP convention)
+    patch_number is the number of patches to be created per image. Only used when inference = False.
+    inference is a flag which tells if subpatches have to be created in order. 
+    If it's false, image is cropped randomly.
+    ovl is the minimum overlap of neighbouring patches in ordered mode. Patches are spread evenly over the
+    image and the last ones end at its borders, on the same grid as whole_image.model_confl (see tiling.py).
+    workers is the number of processes the image folders are spread over.
+    seed is used to derive one independent random generator per image, so that random crops can be
+    reproduced whatever the number of workers. None for a random seed.
+    Random patches are drawn uniformly among the non empty ones (see PatchSampler). With class_balance,
+    half of them are drawn among the patches with a tissue mask and half among the ones with a mag mask.
+    output_format is "tiff" for one directory per patch with one tif per channel and mask, or "packed"
+    for one memory mappable container per image (see packed.py).
+    mask_format is used by the tiff format: "instances" saves one tif per instance mask, "labels" one
+    uint16 instance label tif per class and patch (see TiffPatchWriter).
+    Label images hold one instance per pixel: with "labels", patches where instances of a class overlap
+    are saved as "instances" instead. The packed format always uses label images, there the last of
+    overlapping instances keeps the shared pixels and a warning is logged.
+    Image folders are processed in sorted order and the k-th one is saved in image_k.
+    The build is resumable and incremental: data_out_path/manifest.json keeps which image_k every folder
+    was saved to and the seed of the build, so running again on the same paths only creates the images
+    of new or changed folders and continues the ones which were interrupted (see create_image_patches).
+    New folders are saved after the existing images.
+    Progress is reported with the logging module (logger "implementations").
+    With profile, the wall time and calls of every stage of every image (decode, sobel, polygons,
+    emptiness, statistics, write) and the peak memory while processing it are logged as json and saved in
+    data_out_path/profile.json, with the peak memory of the whole build (peak_rss, the largest of the one
+    of this process and of the images).
+    Returns the total number of saved patches."""
+    if not os.path.exists(data_out_path):
+        os.makedirs(data_out_path)
+    
+    start = time.time()
+    
+    # assign image directories, keeping the ones of a previous build
+    
+    manifest_path = os.path.join(data_out_path, MANIFEST_FILE)
+    manifest = load_manifest(manifest_path) or {"images": {}, "seed": None}
+    
+    if seed is None:
+        seed = manifest["seed"] if manifest["seed"] is not None else np.random.SeedSequence().entropy
+    manifest["seed"] = seed
+    
+    image_list = sorted(os.listdir(data_in_path))
+    for folder in image_list:
+        if folder not in manifest["images"]:
+            manifest["images"][folder] = f"image_{len(manifest['images'])}"
+    save_manifest(manifest_path, manifest)
+    
+    jobs = []
+    for folder in image_list:
+        image_name = manifest["images"][folder]
+        image_counter = int(image_name.split("_")[-1])
+        jobs.append(dict(data_path = os.path.join(data_in_path, folder),
+                         image_path = os.path.join(data_out_path, image_name),
+                         patch_dimensions = patch_dimensions, patch_number = patch_number,
+                         inference = inference, ovl = ovl, save_all = save_all,
+                         seed = np.random.SeedSequence(seed, spawn_key = (image_counter,)),
+                         output_format = output_format, mask_format = mask_format,
+                         class_balance = class_balance, profile = profile))
+    
+    # images are independent, spread them over a process pool if asked to
+    
+    if workers > 1:
+        with concurrent.futures.ProcessPoolExecutor(max_workers = workers) as executor:
+            results = list(executor.map(_create_image_patches_job, jobs))
+    else:
+        results = [_create_image_patches_job(job) for job in jobs]
+    saved_patches = [result[0] for result in results]
+    
+    end = time.time()
+    for i, folder in enumerate(image_list):
+        logger.info("%s: %d patches from %s", manifest['images'][folder], saved_patches[i], folder)
+    logger.info("Done! %d patches from %d images. Elapsed time: %s", sum(saved_patches), len(image_list), end-start)
+    
+    if profile:
+        summary = {"images": {manifest["images"][folder]: results[i][1] for i, folder in enumerate(image_list)},
+                   "total_seconds": end - start}
+        image_peaks = [image_summary["image_peak_rss"] for image_summary in summary["images"].values()
+                       if image_summary["image_peak_rss"] is not None]
+        process_peak = peak_rss()
+        summary["peak_rss"] = max(image_peaks + ([process_peak["self"]] if process_peak is not None else []), default = None)
+        for image_name, image_summary in summary["images"].items():
+            logger.info("profile %s %s", image_name, json.dumps(image_summary))
+        with open(os.path.join(data_out_path, "profile.json"), "w") as f:
+            json.dump(summary, f, indent = 2)
+    
+    return sum(saved_patches)
 
@@ -0,0 +1,306 @@
+
+# coding: utf-8
+
+
+import os
+import json
+import shutil
+import logging
+import numpy as np
+import scipy.ndimage
+import skimage
+
+""" Packed patch database format.
+Instead of one directory per patch with one tif per channel and per mask, all the patches of an image are
+saved in the image directory as:
+channels.dat: uint8 raw array of shape (n_patches, height, width, n_channels), memory mappable.
+tissue.dat, mag.dat: uint16 raw arrays of shape (n_patches, height, width) with one instance label image
+per patch and class. 0 is background, instance k is labelled k + 1. Where instances of the same class
+overlap, the pixels belong to the last one: the earlier instances lose them, a warning is logged.
+index.json: channel names, patch dimensions and one record per patch with its name, its offset in the
+.dat files (in patches) and its number of instances per class."""
+
+INDEX_FILE = "index.json"
+CHANNELS_FILE = "channels.dat"
+MASK_FILES = {"tissue": "tissue.dat", "mag": "mag.dat"}
+
+logger = logging.getLogger(__name__)
+
+
+def is_packed_image(image_path):
+    """ Checks if the image directory image_path is saved in the packed format."""
+    return os.path.exists(os.path.join(image_path, INDEX_FILE))
+
+
+
+def label_image(masks, shape):
+    """ Merges a list of instance masks into one uint16 label image of the given shape.
+    Instance k is labelled k + 1. Where instances overlap, the last one is kept."""
+    labels = np.zeros(shape, dtype = np.uint16)
+    for k in range(len(masks)):
+        labels[masks[k] > 0] = k + 1
+    return labels
+
+
+
+def masks_overlap(masks):
+    """ Checks if a pixel belongs to more than one of a list of instance masks, i.e. if label_image would
+    take pixels from an instance."""
+    covered = None
+    for mask in masks:
+        mask = np.asarray(mask) > 0
+        if covered is None:
+            covered = mask.copy()
+        elif (covered & mask).any():
+            return True
+        else:
+            covered |= mask
+    return False
+
+
+
+def count_labels(labels):
+    """ Returns the number of instances present in a label image, i.e. of its distinct non zero labels."""
+    return int(np.count_nonzero(np.bincount(labels.ravel())[1:]))
+
+
+
+def label_masks(labels, n_instances = None):
+    """ Expands a label image into (height, width, n_instances) bool masks with one vectorized comparison.
+    n_instances defaults to the highest label. Instances lost under later ones are removed."""
+    if n_instances is None:
+        n_instances = int(labels.max())
+    masks = labels[:, :, np.newaxis] == np.arange(1, n_instances + 1, dtype = labels.dtype)
+    return masks[:, :, masks.any(axis = (0, 1))]
+
+
+
+def label_crops(labels, n_instances = None):
+    """ Returns the bounding boxes and the cropped bool masks of the instances of a label image, without
+    expanding it to one full size mask per instance. Bounding boxes are a (n, 4) int array of
+    [y1, x1, y2, x2], y2 and x2 excluded as in mrcnn.utils.extract_bboxes.
+    n_instances defaults to the highest label. Instances lost under later ones are removed."""
+    bboxes = []
+    masks = []
+    for k, window in enumerate(scipy.ndimage.find_objects(labels, max_label = n_instances or 0)):
+        if window is None:
+            continue
+        bboxes.append([window[0].start, window[1].start, window[0].stop, window[1].stop])
+        masks.append(labels[window] == k + 1)
+    return np.array(bboxes, dtype = int).reshape(-1, 4), masks
+
+
+
+def crop_mask(mask):
+    """ Returns the bounding box [y1, x1, y2, x2] (y2 and x2 excluded) of a non empty full size mask
+    and the bool mask cropped to it."""
+    rows = np.flatnonzero(mask.any(axis = 1))
+    cols = np.flatnonzero(mask.any(axis = 0))
+    bbox = [rows[0], cols[0], rows[-1] + 1, cols[-1] + 1]
+    return bbox, mask[bbox[0]:bbox[2], bbox[1]:bbox[3]].astype(bool)
+
+
+
+class PackedImageWriter:
+    """ Writes the patches of one image in the packed format. Patches are appended to the .dat files
+    as they are written, the index is saved by checkpoint() and close().
+    resume is the number of patches of a previous interrupted writer to keep, they must have been
+    saved by a checkpoint. Later patches of the previous writer are discarded."""
+
+    def __init__(self, image_path, channels, patch_dimensions, resume = 0):
+        self.image_path = image_path
+        self.index = {"channels": list(channels),
+                      "patch_dimensions": list(patch_dimensions),
+                      "patches": []}
+        if not os.path.exists(image_path):
+            os.makedirs(image_path)
+
+        mode = "wb"
+        if resume > 0:
+            with open(os.path.join(image_path, INDEX_FILE)) as f:
+                self.index["patches"] = json.load(f)["patches"][:resume]
+            mode = "r+b"
+
+        # keep the first resume patches of the .dat files and append after them
+
+        height, width = patch_dimensions
+        self.channels_file = open(os.path.join(image_path, CHANNELS_FILE), mode)
+        self.channels_file.truncate(resume * height * width * len(self.index["channels"]))
+        self.channels_file.seek(0, os.SEEK_END)
+        self.mask_files = {}
+        for name in MASK_FILES:
+            self.mask_files[name] = open(os.path.join(image_path, MASK_FILES[name]), mode)
+            self.mask_files[name].truncate(resume * height * width * 2)
+            self.mask_files[name].seek(0, os.SEEK_END)
+
+    def write_patch(self, patch_name, file_name, channels, t_masks, m_masks):
+        """ Appends a patch. channels is a dict of channel name to image, in the order given to the writer.
+        t_masks and m_masks are the lists of tissue and mag instance masks of the patch.
+        file_name is only used by the tiff layout and is ignored."""
+        shape = tuple(self.index["patch_dimensions"])
+        for name, masks in [("tissue", t_masks), ("mag", m_masks)]:
+            if masks_overlap(masks):
+                logger.warning("%s: overlapping %s instances in patch %s, the last one keeps the shared pixels",
+                               self.image_path, name, patch_name)
+        image = np.stack([skimage.img_as_ubyte(channels[name]) for name in self.index["channels"]], axis = 2)
+
+        self.channels_file.write(np.ascontiguousarray(image).tobytes())
+        self.mask_files["tissue"].write(label_image(t_masks, shape).tobytes())
+        self.mask_files["mag"].write(label_image(m_masks, shape).tobytes())
+
+        self.index["patches"].append({"name": patch_name,
+                                      "offset": len(self.index["patches"]),
+                                      "n_tissue": len(t_masks),
+                                      "n_mag": len(m_masks)})
+
+    def checkpoint(self):
+        """ Flushes the .dat files and saves the index of the patches written so far."""
+        self.channels_file.flush()
+        for mask_file in self.mask_files.values():
+            mask_file.flush()
+        tmp_path = os.path.join(self.image_path, INDEX_FILE + ".tmp")
+        with open(tmp_path, "w") as f:
+            json.dump(self.index, f)
+        os.replace(tmp_path, os.path.join(self.image_path, INDEX_FILE))
+
+    def close(self):
+        """ Saves the index and closes the .dat files."""
+        self.checkpoint()
+        self.channels_file.close()
+        for mask_file in self.mask_files.values():
+            mask_file.close()
+
+
+
+class PackedImage:
+    """ Reads the patches of one image saved in the packed format. The .dat files are memory mapped,
+    so only the patches which are accessed are read from disk."""
+
+    def __init__(self, image_path):
+        with open(os.path.join(image_path, INDEX_FILE)) as f:
+            self.index = json.load(f)
+        self.channels = self.index["channels"]
+        self.patches = self.index["patches"]
+        height, width = self.index["patch_dimensions"]
+        n_patches = len(self.patches)
+
+        # empty files can not be memory mapped, e.g. of an ordered image without annotated patches
+
+        if n_patches == 0:
+            self.images = np.zeros((0, height, width, len(self.channels)), dtype = np.uint8)
+            self.labels = {name: np.zeros((0, height, width), dtype = np.uint16) for name in MASK_FILES}
+            return
+
+        self.images = np.memmap(os.path.join(image_path, CHANNELS_FILE), dtype = np.uint8, mode = "r",
+                                shape = (n_patches, height, width, len(self.channels)))
+        self.labels = {name: np.memmap(os.path.join(image_path, MASK_FILES[name]), dtype = np.uint16, mode = "r",
+                                       shape = (n_patches, height, width))
+                       for name in MASK_FILES}
+
+    def __len__(self):
+        return len(self.patches)
+
+    def load_image(self, patch_index, channels):
+        """ Returns the (height, width, n_channels) image of a patch with the given list of channels.
+        "none" gives an empty channel."""
+        offset = self.patches[patch_index]["offset"]
+        image = []
+        for channel in channels:
+            if channel == "none":
+                image.append(np.zeros(self.images.shape[1:3], dtype = np.uint8))
+            else:
+                image.append(self.images[offset, :, :, self.channels.index(channel)])
+        return np.stack(image, axis = 2)
+
+    def load_mask(self, patch_index):
+        """ Returns the (height, width, n_instances) bool masks of a patch and their class ids,
+        mag instances first as in the tiff layout."""
+        offset = self.patches[patch_index]["offset"]
+        masks = []
+        classes = []
+        for name, class_id in [("mag", 2), ("tissue", 1)]:
+            masks.append(label_masks(self.labels[name][offset], self.patches[patch_index][f"n_{name}"]))
+            classes.append(np.full(masks[-1].shape[2], class_id))
+        return np.concatenate(masks, axis = 2), np.concatenate(classes).astype(int)
+
+    def load_mask_cropped(self, patch_index):
+        """ Returns the bounding boxes, the list of cropped masks and the class ids of the instances of
+        a patch, mag instances first, see label_crops."""
+        offset = self.patches[patch_index]["offset"]
+        bboxes = []
+        masks = []
+        classes = []
+        for name, class_id in [("mag", 2), ("tissue", 1)]:
+            class_bboxes, class_masks = label_crops(self.labels[name][offset], self.patches[patch_index][f"n_{name}"])
+            bboxes.append(class_bboxes)
+            masks += class_masks
+            classes.append(np.full(len(class_masks), class_id))
+        return np.concatenate(bboxes), masks, np.concatenate(classes).astype(int)
+
+
+
+def convert_database(data_in_path, data_out_path):
+    """ Converts a database saved by create_database in the tiff directory layout, with either mask format,
+    to the packed format. Every image directory of data_in_path is written with the same name in data_out_path."""
+    if not os.path.exists(data_out_path):
+        os.makedirs(data_out_path)
+
+    for image_name in sorted(os.listdir(data_in_path)):
+
+        image_path = os.path.join(data_in_path, image_name)
+        if not os.path.isdir(image_path):
+            continue
+
+        print("Converting ", image_name)
+
+        writer = None
+        label_classes = None
+
+        for patch_name in sorted(os.listdir(image_path)):
+
+            patch_path = os.path.join(image_path, patch_name)
+            if not os.path.isdir(patch_path):
+                continue
+            patch_image_path = os.path.join(patch_path, "images")
+
+            # channel name is the last part of the file name, e.g. patch_3_base.tif
+
+            channels = {}
+            for filename in sorted(os.listdir(patch_image_path)):
+                channel = os.path.splitext(filename)[0].split("_")[-1]
+                channels[channel] = skimage.io.imread(os.path.join(patch_image_path, filename))
+
+            masks = {}
+            label_path = os.path.join(patch_path, "labels")
+            if os.path.isdir(label_path):
+
+                # mask_format = "labels": one instance label tif per class, listed in the classes.json of the image
+
+                if label_classes is None:
+                    with open(os.path.join(image_path, "classes.json")) as f:
+                        label_classes = json.load(f)
+                for label_class in label_classes:
+                    labels = skimage.io.imread(os.path.join(label_path, label_class["file"]))
+                    masks[label_class["name"]] = list(np.moveaxis(label_masks(labels), 2, 0))
+            else:
+                for name in MASK_FILES:
+                    mask_path = os.path.join(patch_path, name)
+                    masks[name] = [skimage.io.imread(os.path.join(mask_path, filename))
+                                   for filename in sorted(os.listdir(mask_path))]
+
+            if writer is None:
+                shape = next(iter(channels.values())).shape
+                writer = PackedImageWriter(os.path.join(data_out_path, image_name), channels.keys(), shape)
+
+            writer.write_patch(patch_name, None, channels, masks["tissue"], masks["mag"])
+
+        if writer is not None:
+            writer.close()
+
+            # the channel statistics saved by create_database (implementations.STATISTICS_FILE and
+            # PATCH_STATISTICS_FILE) are the same for the converted patches
+
+            for statistics_file in ("statistics.json", "patch_statistics.json"):
+                statistics_path = os.path.join(image_path, statistics_file)
+                if os.path.exists(statistics_path):
+                    shutil.copyfile(statistics_path, os.path.join(data_out_path, image_name, statistics_file))
@@ -0,0 +1,154 @@
+
+# coding: utf-8
+
+
+import os
+import collections
+import threading
+import concurrent.futures
+import numpy as np
+
+""" Prefetching of the samples of a dataset.
+Reading and decoding the tifs of a patch runs on the training process, between two steps of the model.
+PrefetchingDataset loads the next samples of a known order of image ids in background threads, so that
+they are ready when the model asks for them. tifffile and numpy release the GIL while reading and
+decoding, so threads run in parallel with the model and with each other.
+Prefetching only pays off when the consumer asks the ids in the given order. Mask R-CNN's model.train
+shuffles the ids itself (data_generator with shuffle = True), so it can not be predicted: use
+SlicesDataset.enable_cache there. For a training loop which follows the ordering, give
+mrcnn.model.data_generator(PrefetchingDataset(dataset, epoch_ordering(dataset.image_ids, epochs)),
+config, shuffle = False) to keras_model.fit_generator: without shuffling, data_generator asks the
+image_ids of the wrapper, i.e. the ordering, one after the other."""
+
+
+def epoch_ordering(image_ids, n_epochs, seed = None):
+    """ Returns an ordering of n_epochs epochs over image_ids, shuffled again at every epoch as
+    data_generator does with shuffle = True."""
+    rng = np.random.default_rng(seed)
+    return np.concatenate([rng.permutation(image_ids) for _ in range(n_epochs)]).tolist()
+
+
+class PrefetchingDataset:
+    """ Wraps a dataset (e.g. slices.SlicesDataset) to load the images and masks of the next image ids
+    of ordering ahead of time, in a pool of workers threads, at most lookahead samples in advance.
+    load_image and load_mask have the interface of the dataset, every other attribute is the one of the
+    dataset, so it can be given in place of the dataset to the Mask R-CNN data generator with
+    shuffle = False.
+    ordering is the sequence of image ids the consumer is expected to ask for, repeated if cycle.
+    When an id which is not the expected one is asked, it is loaded synchronously and prefetching
+    continues after its next occurrence in ordering. hits and misses count both cases.
+    image_ids is the ordering, so that a consumer iterating over image_ids follows it.
+    Threads are started by the first load and again in a forked process (e.g. a Keras multiprocessing
+    worker), which can not use the threads of its parent: samples pending in the parent are dropped."""
+
+    def __init__(self, dataset, ordering, workers = 4, lookahead = 16, cycle = True):
+        self.dataset = dataset
+        self.ordering = list(ordering)
+        self.cycle = cycle
+        self.lookahead = lookahead
+        self.workers = workers
+        self.hits = 0
+        self.misses = 0
+
+        self._pid = None
+        self._executor = None
+        self._pending = collections.deque()
+        self._position = 0
+        self._loaded = {}
+
+    @property
+    def image_ids(self):
+        return np.array(self.ordering, dtype = int)
+
+    def _start(self):
+        # (re)creates the threads in this process, after a fork prefetching restarts at the first pending id
+        if self._pid == os.getpid():
+            return
+        if self._pending and self.ordering:
+            self._position = (self._position - len(self._pending)) % len(self.ordering)
+        self._pid = os.getpid()
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers = self.workers)
+        self._pending = collections.deque()
+        self._loaded = {}
+
+        # samples of the same id are never loaded concurrently, e.g. for the random patches of wafers
+
+        self._id_locks = collections.defaultdict(threading.Lock)
+        self._fill()
+
+    def __getattr__(self, name):
+        # only called for attributes which are not found on the wrapper
+        return getattr(self.__dict__["dataset"], name)
+
+    def _load(self, image_id):
+        with self._id_locks[image_id]:
+            image = self.dataset.load_image(image_id)
+            masks, class_ids = self.dataset.load_mask(image_id)
+        return image, masks, class_ids
+
+    def _fill(self):
+        # submit the next ids of ordering until lookahead samples are pending
+        while len(self._pending) < self.lookahead and self.ordering:
+            if self._position == len(self.ordering):
+                if not self.cycle:
+                    return
+                self._position = 0
+            image_id = self.ordering[self._position]
+            self._id_locks[image_id] # lock created here rather than concurrently by the workers
+            self._pending.append((image_id, self._executor.submit(self._load, image_id)))
+            self._position += 1
+
+    def _resync(self, image_id):
+        # drop the pending samples before image_id, or all of them and restart after image_id
+        pending_ids = [pending_id for pending_id, _ in self._pending]
+        if image_id in pending_ids:
+            for _ in range(pending_ids.index(image_id)):
+                self._pending.popleft()[1].cancel()
+            return True
+        while self._pending:
+            self._pending.popleft()[1].cancel()
+        positions = [k for k in range(len(self.ordering)) if self.ordering[k] == image_id]
+        if positions:
+            later = [k for k in positions if k >= self._position]
+            self._position = (later[0] if later else positions[0]) + 1
+        return False
+
+    def _take(self, image_id):
+        # sample of image_id, prefetched if it is the next one
+        self._start()
+        if not (self._pending and self._pending[0][0] == image_id) and not self._resync(image_id):
+            self.misses += 1
+            sample = self._load(image_id)
+        else:
+            self.hits += 1
+            sample = self._pending.popleft()[1].result()
+        self._fill()
+        return sample
+
+    def load_image(self, image_id):
+        """ Returns the image of image_id, its masks are kept for the following load_mask."""
+        sample = self._take(image_id)
+        self._loaded[image_id] = sample
+        return sample[0]
+
+    def load_mask(self, image_id):
+        """ Returns the masks and class ids of image_id, the ones of the last load_image if any."""
+        if image_id in self._loaded:
+            return self._loaded.pop(image_id)[1:]
+        return self._take(image_id)[1:]
+
+    def close(self):
+        """ Cancels the pending samples and stops the threads of this process."""
+        if self._pid != os.getpid():
+            return
+        for _, future in self._pending:
+            future.cancel()
+        self._pending.clear()
+        self._executor.shutdown(wait = True)
+        self._pid = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
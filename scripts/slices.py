@@ -7,7 +7,178 @@
 from mrcnn import utils
 import numpy as np
 import os
+import json
+import threading
+import collections
 import skimage
+import tifffile
+import packed
+import channels as derived_channels
+import implementations
+import wafer_image
+
+
+SLICES_INDEX_FILE = "slices_index.json"
+
+
+def count_label_instances(label_file):
+    """ Returns the number of instances of an instance label tif, read from the tif description written by
+    TiffPatchWriter, or counted in the decoded image for label tifs saved without it."""
+    with tifffile.TiffFile(label_file) as tif:
+        metadata = tif.shaped_metadata
+        if metadata and "instances" in metadata[0]:
+            return int(metadata[0]["instances"])
+        return packed.count_labels(tif.asarray())
+
+
+
+def index_patch(patch_path):
+    """ Returns the index record of a patch saved in the tiff layout: its name, height and width read from
+    the tif header of its first image, its channel files and its number of tissue and mag instances."""
+    patch_image_path = os.path.join(patch_path,"images")
+    file_list = os.listdir(patch_image_path)
+    
+    with tifffile.TiffFile(os.path.join(patch_image_path,file_list[0])) as tif:
+        height, width = tif.pages[0].shape[:2]
+    
+    # channel name is the last part of the file name, e.g. patch_3_base.tif
+    
+    channel_files = {os.path.splitext(x)[0].split("_")[-1]: x for x in sorted(file_list)}
+    
+    label_path = os.path.join(patch_path,"labels")
+    if os.path.isdir(label_path):
+        n_tissue = count_label_instances(os.path.join(label_path,"tissue_labels.tif"))
+        n_mag = count_label_instances(os.path.join(label_path,"mag_labels.tif"))
+    else:
+        n_tissue = len(os.listdir(os.path.join(patch_path,"tissue")))
+        n_mag = len(os.listdir(os.path.join(patch_path,"mag")))
+    
+    return {"name": os.path.basename(patch_path), "height": int(height), "width": int(width),
+            "channel_files": channel_files, "n_tissue": n_tissue, "n_mag": n_mag}
+
+
+
+def patch_signature(patch_path):
+    """ Returns the modification times of the subdirectories of a patch directory of the tiff layout and
+    of the files of its images and labels subdirectories, as a list of [path, mtime_ns], so that it changes
+    whenever a channel or a mask of the patch is added, removed or rewritten. The derived directory of
+    memoize_derived is not considered."""
+    signature = []
+    for entry in os.scandir(patch_path):
+        if entry.name == "derived" or not entry.is_dir():
+            continue
+        signature.append([entry.name, entry.stat().st_mtime_ns])
+        if entry.name in ("images", "labels"):
+            signature += [[entry.name + "/" + x.name, x.stat().st_mtime_ns] for x in os.scandir(entry.path)]
+    return sorted(signature)
+
+
+
+def index_image(image_path, cached = None, n_patches = None):
+    """ Returns the index of an image directory saved in the tiff layout: its patch names in os.listdir order
+    and the records (see index_patch) of its first n_patches patches, of all of them if None.
+    cached is the index of a previous call. It is up to date when neither the image directory nor the
+    manifest.json of create_database were modified since and the manifest marked the image as complete:
+    its records are then used without reading the patch directories. Otherwise the patch list is read
+    again if the directory was modified, and the records of the patches to load are kept only if their
+    patch_signature did not change, the other records are dropped. cached itself is returned when
+    nothing changed."""
+    mtime_ns = os.stat(image_path).st_mtime_ns
+    manifest_path = os.path.join(image_path, implementations.MANIFEST_FILE)
+    try:
+        manifest_mtime_ns = os.stat(manifest_path).st_mtime_ns
+    except FileNotFoundError:
+        manifest_mtime_ns = None
+    
+    # indices saved by previous versions have no names
+    
+    if cached is not None and "names" not in cached:
+        cached = None
+    
+    up_to_date = (cached is not None and cached["mtime_ns"] == mtime_ns
+                  and cached["manifest_mtime_ns"] == manifest_mtime_ns and cached["complete"])
+    
+    if up_to_date:
+        complete = True
+        records = cached["patches"]
+    else:
+        
+        # images of a build in progress may be rewritten, databases without manifest are not
+        
+        manifest = implementations.load_manifest(manifest_path)
+        complete = manifest is None or manifest.get("complete", False)
+        records = {}
+    
+    if cached is not None and cached["mtime_ns"] == mtime_ns:
+        names = cached["names"]
+    else:
+        names = [x.name for x in os.scandir(image_path) if x.is_dir()]
+    
+    changed = not up_to_date
+    for x in names[:n_patches]:
+        if x in records:
+            continue
+        patch_path = os.path.join(image_path,x)
+        signature = patch_signature(patch_path)
+        record = cached["patches"].get(x) if cached is not None else None
+        if record is None or record["signature"] != signature:
+            record = index_patch(patch_path)
+            record["signature"] = signature
+        records[x] = record
+        changed = True
+    
+    if not changed:
+        return cached
+    return {"mtime_ns": mtime_ns, "manifest_mtime_ns": manifest_mtime_ns, "complete": complete,
+            "names": names, "patches": records}
+
+
+
+class PatchCache:
+    """ Least recently used cache of decoded patch arrays, bounded by a total size in bytes.
+    Values are tuples of numpy arrays, made read only so that users can not modify the cached copy.
+    Thread safe, hits and misses are counted."""
+    
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.n_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+    
+    def get(self, key):
+        """ Returns the cached value of key, None if it is not cached."""
+        with self._lock:
+            if key not in self._entries:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._entries.move_to_end(key)
+            return self._entries[key]
+    
+    def put(self, key, value):
+        """ Caches value, evicting the least recently used entries when the budget is exceeded.
+        Values larger than the whole budget are not cached. Only the arrays of a cached value are made
+        read only, the ones of a value which is not cached are left untouched."""
+        size = sum(array.nbytes for array in value)
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                return
+            for array in value:
+                array.setflags(write = False)
+            self._entries[key] = value
+            self.n_bytes += size
+            while self.n_bytes > self.max_bytes:
+                _, evicted = self._entries.popitem(last = False)
+                self.n_bytes -= sum(array.nbytes for array in evicted)
+    
+    def stats(self):
+        """ Returns the hits, misses, number of entries and size in bytes of the cache."""
+        return {"hits": self.hits, "misses": self.misses, "entries": len(self._entries), "bytes": self.n_bytes}
+
 
 
 class SlicesDataset(utils.Dataset):
@@ -18,9 +189,17 @@ class SlicesDataset(utils.Dataset):
         """Load a subset of the Slices dataset.
         dataset_dir: Root directory of the dataset.
         n_images: number of images to load. Will load in os.listdir list order.
-        n_patches: number of patches to load per image.
+        n_patches: number of patches to load per image, all of them for images with fewer patches.
         channels: list of strings indicating channels to be stacked in the image.
-        currently "base", "mf", "edges" and "none" can be arbitrarily stacked.
+        "base", "mf", "edges" and "none" and the derived channels of channels.py can be arbitrarily stacked.
+        Image directories can be saved either in the tiff layout or in the packed format of packed.py.
+        Patch shapes, channel files and instance counts of the tiff layout are kept in
+        dataset_dir/slices_index.json. The patch directories of an image are only read again if the image
+        directory or its manifest were modified since, or the manifest did not mark it as complete.
+        The channel statistics saved by create_database for the loaded images are merged in
+        self.statistics (an implementations.ChannelStatistics), None if an image has none. The mean of the
+        loaded channels over the loaded patches only is self.mean_pixel, to be used as config.MEAN_PIXEL. It
+        is None if a loaded patch or channel has no saved pixel sums, e.g. a derived channel.
         """
         
         # add classes to be trained on
@@ -30,86 +209,432 @@ class SlicesDataset(utils.Dataset):
         
         # collect image list and initialize counter
         
-        image_list = os.listdir(dataset_dir)
+        image_list = [x for x in os.listdir(dataset_dir) if os.path.isdir(os.path.join(dataset_dir,x))]
         image_counter = 0
         patch_counter = 0
         
+        index_path = os.path.join(dataset_dir, SLICES_INDEX_FILE)
+        index = {}
+        if os.path.exists(index_path):
+            with open(index_path) as f:
+                index = json.load(f)
+        index_changed = False
+        
+        # names of the loaded patches of every image, for their pixel sums
+        
+        loaded_patches = {}
+        
         # cycle over images and save patches to database.
         
         for i in range(n_images):
             
             image_path = os.path.join(dataset_dir,image_list[i])
-            patch_list = os.listdir(image_path)
             
             print(f"processing: image {i}")    
             
-            for j in range(n_patches):
-                
-                patch_path = os.path.join(image_path, patch_list[j])
-                
-                patch_image_path = os.path.join(patch_path,"images")
-                
-                file_list = os.listdir(patch_image_path)
-                
-                image_file_path = os.path.join(patch_image_path,file_list[0])
+            # images saved in the packed format already know their patches
+            
+            if packed.is_packed_image(image_path):
+                packed_image = self.packed_image(image_path)
+                height, width = packed_image.index["patch_dimensions"]
+                loaded_patches[image_list[i]] = [patch["name"] for patch in packed_image.patches[:n_patches]]
+                for j in range(min(n_patches, len(packed_image))):
+                    self.add_image(
+                        "slices",
+                        image_id = patch_counter,
+                        path = image_path,
+                        width = width, height = height,
+                        channels = channels,
+                        packed_index = j,
+                    )
+                    patch_counter += 1
+                continue
+            
+            image_index = index_image(image_path, index.get(image_list[i]), n_patches)
+            if image_index is not index.get(image_list[i]):
+                index[image_list[i]] = image_index
+                index_changed = True
+            
+            loaded_patches[image_list[i]] = image_index["names"][:n_patches]
+            for name in image_index["names"][:n_patches]:
                 
-                image = skimage.io.imread(image_file_path)
+                patch = image_index["patches"][name]
                 
-                height, width = image.shape
-            
                 self.add_image(
                     "slices",
                     image_id = patch_counter,
-                    path = patch_path,
-                    width = width, height = height,
+                    path = os.path.join(image_path, patch["name"]),
+                    width = patch["width"], height = patch["height"],
                     channels = channels,
+                    channel_files = patch["channel_files"],
+                    n_tissue = patch["n_tissue"], n_mag = patch["n_mag"],
                 )
                 patch_counter += 1
+        
+        # channel statistics of the loaded images, added to the ones of previous calls
+        
+        statistics = implementations.load_statistics(dataset_dir, image_list[:n_images])
+        if statistics is not None and getattr(self, "statistics", None) is not None:
+            statistics.merge(self.statistics)
+        elif getattr(self, "statistics", False) is None:
+            statistics = None
+        self.statistics = statistics
+        
+        # the mean pixel only counts the loaded patches, added to the ones of previous calls
+        
+        pixel_sums = implementations.load_pixel_sums(dataset_dir, loaded_patches)
+        previous_sums = getattr(self, "_pixel_sums", {})
+        if pixel_sums is not None and previous_sums is not None:
+            for name, (count, total) in previous_sums.items():
+                channel = pixel_sums.setdefault(name, [0, 0])
+                channel[0] += count
+                channel[1] += total
+        else:
+            pixel_sums = None
+        self._pixel_sums = pixel_sums
+        
+        # derived channels which are not stored in the database have no saved statistics
+        
+        if pixel_sums is not None and all(name == "none" or name in pixel_sums for name in channels):
+            self.mean_pixel = np.array([pixel_sums[name][1] / pixel_sums[name][0] if name != "none" else 0.
+                                        for name in channels])
+        else:
+            self.mean_pixel = None
+        
+        # save the index for the next runs, skipped on read only datasets
+        
+        if index_changed:
+            try:
+                with open(index_path + ".tmp", "w") as f:
+                    json.dump(index, f)
+                os.replace(index_path + ".tmp", index_path)
+            except OSError:
+                pass
+    
+    
+    
+    def load_wafers(self, data_dir, n_samples, patch_dimensions = [512,512], channels = ["base"], seed = None,
+                    class_balance = False):
+        """Load whole wafers to crop random patches on the fly, instead of reading a database of patches.
+        data_dir: directory of the original data, one folder per wafer as given to create_database.
+        n_samples: number of image ids per wafer, i.e. patches per wafer and epoch.
+        patch_dimensions: y and x dimensions of the patches.
+        channels: list of channels to be stacked in the image, as in load_slices.
+        seed: seed of the random generator of the crops, None for a random seed.
+        class_balance: draw half of the patches among the ones with tissue and half among the ones with mag.
+        Wafer channels are memory mapped when possible and polygons are loaded once. Every call of
+        load_image draws a new non empty patch, load_mask returns the masks of the patch last drawn
+        for the same id (or of a new one if none is pending).
+        """
+        
+        # add classes to be trained on
+        
+        self.add_class("slices", 1, "tissue")
+        self.add_class("slices", 2, "mag")
+        
+        self._wafers = {}
+        self._samples = {}
+        self._rng = np.random.default_rng(seed)
+        self._class_balance = class_balance
+        image_counter = len(self.image_info)
+        
+        for folder in sorted(os.listdir(data_dir)):
             
-
-
+            data_path = os.path.join(data_dir, folder)
+            if not os.path.isdir(data_path):
+                continue
+            
+            print(f"loading: wafer {folder}")
+            
+            ic_image_path, mf_image_path, tissue_path, mag_path = implementations.find_image_files(data_path)
+            positions_t = implementations.import_txt(tissue_path)
+            positions_m = implementations.import_txt(mag_path)
+            
+            image = wafer_image.WaferImage([ic_image_path, mf_image_path], ["base", "mf"])
+            index = implementations.PolygonIndex(positions_t, positions_m)
+            self._wafers[data_path] = {"image": image,
+                                       "sampler": implementations.PatchSampler(index, image.shape[:2], patch_dimensions)}
+            
+            for j in range(n_samples):
+                self.add_image(
+                    "slices",
+                    image_id = image_counter,
+                    path = data_path,
+                    width = patch_dimensions[1], height = patch_dimensions[0],
+                    channels = channels,
+                    wafer = True,
+                )
+                image_counter += 1
+    
+    def sample_wafer_patch(self, image_id):
+        """Draws a new non empty patch of the wafer of image_id and keeps it for load_mask.
+        Returns the patch boundaries and its tissue and mag masks."""
+        info = self.image_info[image_id]
+        wafer = self._wafers[info['path']]
+        sample = wafer["sampler"].sample(self._rng, self._class_balance)
+        self._samples[image_id] = sample
+        return sample
+    
+    def load_wafer_image(self, image_id):
+        """Returns a new random patch of the wafer of image_id, see load_wafers."""
+        info = self.image_info[image_id]
+        wafer = self._wafers[info['path']]
+        boundaries, _, _ = self.sample_wafer_patch(image_id)
+        
+        def load(channel):
+            # the edges are computed with the pixels around the patch, other derived channels on the patch
+            if channel == "none":
+                return np.zeros((info['height'], info['width']), dtype = np.uint8)
+            if channel == "edges":
+                return implementations.edges_window(wafer["image"].channel("base"), boundaries)
+            if channel in wafer["image"].names:
+                return skimage.img_as_ubyte(wafer["image"].read_window(boundaries, [channel])[:,:,0])
+            return derived_channels.derive(channel, load)
+        
+        return np.stack([load(channel) for channel in info['channels']], axis=2)
+    
+    def load_wafer_mask(self, image_id):
+        """Returns the masks of the patch last drawn by load_image for image_id, see load_wafers."""
+        masks, classes = self.wafer_masks(image_id)
+        return np.stack(masks,axis=2), np.asarray(classes).astype(int)
+    
+    def wafer_masks(self, image_id):
+        """Returns the list of masks of the patch last drawn by load_image for image_id, mag masks first,
+        and their class ids."""
+        if image_id in self._samples:
+            _, t_masks, m_masks = self._samples.pop(image_id)
+        else:
+            _, t_masks, m_masks = self.sample_wafer_patch(image_id)
+            del self._samples[image_id]
+        
+        # mag masks first as in the database
+        
+        masks = [mask.astype(bool) for mask in m_masks + t_masks]
+        classes = [2] * len(m_masks) + [1] * len(t_masks)
+        
+        return masks, classes
+    
+    def packed_image(self, image_path):
+        """Returns the reader of an image saved in the packed format, opened once per image."""
+        if not hasattr(self, "_packed_images"):
+            self._packed_images = {}
+        if image_path not in self._packed_images:
+            self._packed_images[image_path] = packed.PackedImage(image_path)
+        return self._packed_images[image_path]
+    
+    def label_classes(self, image_path):
+        """Returns the class table of an image saved with instance label masks, read once per image."""
+        if not hasattr(self, "_label_classes"):
+            self._label_classes = {}
+        if image_path not in self._label_classes:
+            with open(os.path.join(image_path, "classes.json")) as f:
+                self._label_classes[image_path] = json.load(f)
+        return self._label_classes[image_path]
+    
+    def load_label_mask(self, label_path):
+        """Loads the masks of a patch saved with one instance label tif per class, in the class table order."""
+        masks = []
+        classes = []
+        for label_class in self.label_classes(os.path.dirname(os.path.dirname(label_path))):
+            labels = skimage.io.imread(os.path.join(label_path, label_class["file"]))
+            masks.append(packed.label_masks(labels))
+            classes.append(np.full(masks[-1].shape[2], label_class["class_id"]))
+        return np.concatenate(masks, axis=2), np.concatenate(classes).astype(int)
+    
+    def enable_cache(self, max_bytes):
+        """Keeps the decoded images and masks in memory, up to max_bytes bytes, so that patches are
+        read from disk only once while they fit (see PatchCache). Cached arrays are read only.
+        Patches cropped from wafers by load_wafers are random and never cached."""
+        self._cache = PatchCache(max_bytes)
+    
+    def cache_stats(self):
+        """Returns the hit and miss counters and the size of the cache, None when it is not enabled."""
+        cache = getattr(self, "_cache", None)
+        return cache.stats() if cache is not None else None
+    
     def load_image(self, image_id):
-        """Returns an image with a given id."""
+        """Returns an image with a given id, from the cache if enabled."""
+        cache = getattr(self, "_cache", None)
+        if cache is None or 'wafer' in self.image_info[image_id]:
+            return self.read_image(image_id)
+        cached = cache.get(("image", image_id))
+        if cached is None:
+            cached = (self.read_image(image_id),)
+            cache.put(("image", image_id), cached)
+        return cached[0]
+    
+    def load_mask(self, image_id):
+        """Returns the masks and class ids of a given id, from the cache if enabled."""
+        cache = getattr(self, "_cache", None)
+        if cache is None or 'wafer' in self.image_info[image_id]:
+            return self.read_mask(image_id)
+        cached = cache.get(("mask", image_id))
+        if cached is None:
+            cached = self.read_mask(image_id)
+            cache.put(("mask", image_id), cached)
+        return cached
+    
+    def load_mask_cropped(self, image_id):
+        """Returns the masks of a given id cropped to their bounding boxes, instead of the full size
+        (height, width, n_instances) stack of load_mask: a (n_instances, 4) int array of bounding boxes
+        [y1, x1, y2, x2] (y2 and x2 excluded, as mrcnn.utils.extract_bboxes), the list of cropped bool
+        masks and the class ids, in the order of load_mask.
+        Label images (packed format and mask_format = "labels") are cropped without expanding them,
+        instance tifs are read and cropped one at a time."""
+        info = self.image_info[image_id]
+        if 'packed_index' in info:
+            return self.packed_image(info['path']).load_mask_cropped(info['packed_index'])
+        
+        label_path = os.path.join(info['path'],"labels")
+        if 'wafer' not in info and os.path.isdir(label_path):
+            bboxes = []
+            masks = []
+            classes = []
+            for label_class in self.label_classes(os.path.dirname(info['path'])):
+                labels = skimage.io.imread(os.path.join(label_path, label_class["file"]))
+                class_bboxes, class_masks = packed.label_crops(labels)
+                bboxes.append(class_bboxes)
+                masks += class_masks
+                classes.append(np.full(len(class_masks), label_class["class_id"]))
+            return np.concatenate(bboxes), masks, np.concatenate(classes).astype(int)
+        
+        # full size masks, cropped one at a time
+        
+        if 'wafer' in info:
+            full_masks, classes = self.wafer_masks(image_id)
+        else:
+            full_masks, classes = self.instance_masks(info['path'])
+        bboxes = []
+        masks = []
+        for mask in full_masks:
+            bbox, cropped = packed.crop_mask(mask)
+            bboxes.append(bbox)
+            masks.append(cropped)
+        return np.array(bboxes, dtype = int).reshape(-1, 4), masks, np.asarray(classes).astype(int)
+    
+    def read_image(self, image_id):
+        """Reads an image with a given id."""
         
         # load image infos
         
         info = self.image_info[image_id]
-        patch_path = info['path']
-        width = info['width']
-        height = info['height']
-        impath = os.path.join(patch_path,"images")
-        file_list = os.listdir(impath)         
-        channels = info['channels']
-        
-        image = []
+        if 'wafer' in info:
+            return self.load_wafer_image(image_id)
         
         # stack channels to be loaded.
         
-        for channel in channels:
+        image = [self.load_channel(image_id, channel) for channel in info['channels']]
+        
+        return np.stack(image, axis=2)
+    
+    def load_channel(self, image_id, channel):
+        """Returns the 8 bit image of one channel of a patch of the database: "none" is an empty channel,
+        channels stored in the database are read, other ones are computed from them if they are
+        registered in channels.py, see memoize_derived."""
+        info = self.image_info[image_id]
+        if channel == "none":
+            return np.zeros((info['height'], info['width']), dtype = np.uint8)
+        channel_image = self.read_stored_channel(image_id, channel)
+        if channel_image is not None:
+            return channel_image
+        if not derived_channels.is_derived(channel):
+            raise ValueError(f"channel {channel} is neither saved in {info['path']} nor a derived channel")
+        return self.derived_channel(image_id, channel)
+    
+    def read_stored_channel(self, image_id, channel):
+        """Reads a channel saved in the database, None if the patch has no such channel."""
+        info = self.image_info[image_id]
+        if 'packed_index' in info:
+            packed_image = self.packed_image(info['path'])
+            if channel not in packed_image.channels:
+                return None
+            return packed_image.load_image(info['packed_index'], [channel])[:,:,0]
+        impath = os.path.join(info['path'],"images")
+        
+        # channel files are known from the index, otherwise listed
+        
+        channel_files = info.get('channel_files')
+        if channel_files is None:
+            file_list = os.listdir(impath)
+            channel_files = {channel: x for x in file_list if channel in x}
+        if channel not in channel_files:
+            return None
+        
+        channel_image = skimage.io.imread(os.path.join(impath, channel_files[channel]))
+        return skimage.img_as_ubyte(channel_image)
+    
+    def memoize_derived(self, memo = "disk", max_bytes = 1 << 30):
+        """Chooses where derived channels are kept once computed: "disk" (the default) saves them as tifs
+        in a derived directory of the patch (of the image for the packed format), "memory" keeps them in
+        a PatchCache of max_bytes bytes, None computes them at every load.
+        Saved derived channels are not updated when the function of the channel changes, remove the
+        derived directories to compute them again. Patches cropped from wafers are never memoized."""
+        self._derived_memo = PatchCache(max_bytes) if memo == "memory" else memo
+    
+    def derived_path(self, image_id, channel):
+        """Returns the path where the derived channel of a patch is saved by memoize_derived("disk")."""
+        info = self.image_info[image_id]
+        if 'packed_index' in info:
+            patch_name = self.packed_image(info['path']).patches[info['packed_index']]['name']
+            return os.path.join(info['path'], "derived", f"{patch_name}_{channel}.tif")
+        return os.path.join(info['path'], "derived", f"{channel}.tif")
+    
+    def derived_channel(self, image_id, channel):
+        """Returns a derived channel of a patch, computed from its other channels or memoized."""
+        memo = getattr(self, "_derived_memo", "disk")
+        
+        def compute():
+            return derived_channels.derive(channel, lambda source: self.load_channel(image_id, source))
+        
+        if memo == "disk":
+            path = self.derived_path(image_id, channel)
+            if os.path.exists(path):
+                return skimage.io.imread(path)
+            channel_image = compute()
             
-            if channel == "none":
-                channel_image = skimage.img_as_ubyte(np.zeros( (height,width) ) )
+            # saved atomically, skipped on read only datasets
             
-            else:
-                channel_image_name = [x for x in file_list if channel in x][0] 
-                channel_image_path = os.path.join(impath, channel_image_name)
-                channel_image = skimage.io.imread(channel_image_path)
-                channel_image = skimage.img_as_ubyte(channel_image)
-            image.append(channel_image)
+            try:
+                os.makedirs(os.path.dirname(path), exist_ok = True)
+                tifffile.imwrite(path + ".tmp", channel_image)
+                os.replace(path + ".tmp", path)
+            except OSError:
+                pass
+            return channel_image
         
-        image = np.stack(image, axis=2)
+        if isinstance(memo, PatchCache):
+            cached = memo.get((channel, image_id))
+            if cached is None:
+                cached = (compute(),)
+                memo.put((channel, image_id), cached)
+            return cached[0]
         
-        return image
+        return compute()
     
-    def load_mask(self, image_id):
+    def read_mask(self, image_id):
         """Loads masks from dataset.
         """
         # load image infos
         
         info = self.image_info[image_id]
+        if 'wafer' in info:
+            return self.load_wafer_mask(image_id)
+        if 'packed_index' in info:
+            return self.packed_image(info['path']).load_mask(info['packed_index'])
         patch_path = info['path']
         height = info['height']
         width = info['width']
+        label_path = os.path.join(patch_path,"labels")
+        if os.path.isdir(label_path):
+            return self.load_label_mask(label_path)
+        
+        masks, classes = self.instance_masks(patch_path)
+                
+        return np.stack(list(masks),axis=2), np.asarray(classes).astype(int)
+    
+    def instance_masks(self, patch_path):
+        """Returns an iterator reading the instance mask tifs of a patch one at a time, mag masks first,
+        and the list of their class ids."""
         mag_path = os.path.join(patch_path,"mag")
         tissue_path = os.path.join(patch_path,"tissue")
         
@@ -118,22 +643,9 @@ class SlicesDataset(utils.Dataset):
         mag_mask_list = os.listdir(mag_path)
         tissue_mask_list = os.listdir(tissue_path)
         
-        classes = []
-        masks = []
-        
-        # append masks and ids in list
-        
-        if mag_mask_list:
-            for filename in mag_mask_list:
-                a = os.path.join(mag_path,filename)
-                masks.append(skimage.io.imread(a).astype(bool))
-                classes.append(2)
+        paths = [os.path.join(mag_path,filename) for filename in mag_mask_list]
+        paths += [os.path.join(tissue_path,filename) for filename in tissue_mask_list]
+        classes = [2] * len(mag_mask_list) + [1] * len(tissue_mask_list)
         
-        if tissue_mask_list:
-            for filename in tissue_mask_list:
-                a = os.path.join(tissue_path,filename)
-                masks.append(skimage.io.imread(a).astype(bool))
-                classes.append(1)
-                
-        return np.stack(masks,axis=2), np.asarray(classes).astype(int)
+        return (skimage.io.imread(a).astype(bool) for a in paths), classes
 
@@ -0,0 +1,65 @@
+
+# coding: utf-8
+
+
+import collections
+import numpy as np
+
+""" Tiling of whole images in overlapping patches.
+The same grid is used to cut the ordered patches of create_database and to apply the model by
+whole_image.model_confl, so database patches and inference patches line up.
+Along every axis, n = ceil((length - min_overlap) / (tile_length - min_overlap)) tiles are spread evenly:
+the first one starts at 0, the last one ends at the image border and neighbouring tiles overlap by at
+least min_overlap pixels, so no pixel is skipped."""
+
+# index is the (row, column) of the tile in the grid, origin its top left pixel, shape its size and halo
+# the ((top, bottom), (left, right)) context pixels around it which are inside the image.
+
+Tile = collections.namedtuple("Tile", ["index", "origin", "shape", "halo"])
+
+
+def tile_origins(length, tile_length, min_overlap = 0):
+    """ Returns the origins of the tiles along an axis of the given length.
+    Tiles are tile_length long, or length when the axis is shorter."""
+    if tile_length - min_overlap <= 0:
+        raise ValueError(f"overlap {min_overlap} must be smaller than the tile length {tile_length}")
+    if length <= tile_length:
+        return np.zeros(1, dtype = int)
+    n_tiles = int(np.ceil((length - min_overlap) / (tile_length - min_overlap)))
+    return np.arange(n_tiles) * (length - tile_length) // (n_tiles - 1)
+
+
+
+def tile_grid(image_shape, tile_shape, min_overlap = 0, halo = 0):
+    """ Returns the list of Tiles covering an image of shape (height, width, ...), row by row.
+    tile_shape is the (height, width) of the tiles, min_overlap the minimum overlap of neighbouring
+    tiles and halo the number of context pixels wanted around every tile, clipped to the image."""
+    height, width = image_shape[:2]
+    tile_height = min(tile_shape[0], height)
+    tile_width = min(tile_shape[1], width)
+
+    tiles = []
+    for i, y in enumerate(tile_origins(height, tile_shape[0], min_overlap).tolist()):
+        for j, x in enumerate(tile_origins(width, tile_shape[1], min_overlap).tolist()):
+            tile_halo = ((min(halo, y), min(halo, height - y - tile_height)),
+                         (min(halo, x), min(halo, width - x - tile_width)))
+            tiles.append(Tile((i, j), (y, x), (tile_height, tile_width), tile_halo))
+    return tiles
+
+
+
+def tile_boundaries(tile, with_halo = False):
+    """ Returns the window [[y1, y2], [x1, x2]] of a tile, y2 and x2 excluded, with its halo if with_halo."""
+    (y, x), (height, width) = tile.origin, tile.shape
+    if not with_halo:
+        return [[y, y + height], [x, x + width]]
+    (top, bottom), (left, right) = tile.halo
+    return [[y - top, y + height + bottom], [x - left, x + width + right]]
+
+
+
+def tile_view(image, tile, with_halo = False):
+    """ Returns the window of a tile in image. For a numpy array this is a view, nothing is copied,
+    for a lazily read image (e.g. wafer_image.WaferImage) only the window is read."""
+    boundaries = tile_boundaries(tile, with_halo)
+    return image[boundaries[0][0]:boundaries[0][1], boundaries[1][0]:boundaries[1][1]]
@@ -0,0 +1,77 @@
+
+# coding: utf-8
+
+
+import numpy as np
+import skimage
+import tifffile
+
+""" Reading of large stitched wafer images by windows.
+Full resolution wafers do not fit in memory once every channel is read and stacked, so channels are
+opened lazily and only the rectangular windows which are needed are read from disk."""
+
+
+def open_channel(path):
+    """ This function opens a single channel tif without reading it in memory when possible.
+    Uncompressed contiguous tifs are memory mapped. Tiled or compressed tifs are opened through zarr,
+    if installed, which decodes only the tiles (or strips) touched by a slice.
+    Otherwise the image is read in memory."""
+    try:
+        return tifffile.memmap(path, mode = "r")
+    except ValueError:
+        pass
+    try:
+        import zarr
+    except ImportError:
+        return skimage.io.imread(path)
+    return zarr.open(tifffile.imread(path, aszarr = True), mode = "r")
+
+
+
+class WaferImage:
+    """ Multi channel wafer image made of one tif per channel, e.g. the BF and DAPI stitched images.
+    Slicing it like a (height, width, n_channels) array, e.g. wafer[y1:y2, x1:x2, :], reads the window of
+    every channel and stacks them, without materializing the stacked whole image. It can be used in
+    place of the stacked ndarray by create_database and whole_image.model_confl."""
+
+    def __init__(self, paths, names = None):
+        """ paths is the list of channel tifs, names an optional list of channel names."""
+        self.paths = list(paths)
+        self.names = list(names) if names is not None else [str(k) for k in range(len(self.paths))]
+        self.channels = [open_channel(path) for path in self.paths]
+
+        height, width = self.channels[0].shape[:2]
+        for path, channel in zip(self.paths, self.channels):
+            if channel.shape[:2] != (height, width):
+                raise ValueError(f"{path} has shape {channel.shape}, expected {(height, width)}")
+
+        self.shape = (height, width, len(self.channels))
+        self.ndim = 3
+        self.dtype = np.result_type(*[channel.dtype for channel in self.channels])
+
+    def channel(self, name):
+        """ Returns the lazily read 2D array of the channel called name."""
+        return self.channels[self.names.index(name)]
+
+    def read_window(self, boundaries, channels = None):
+        """ Returns the (y2 - y1, x2 - x1, n_channels) window boundaries = [[y1, y2], [x1, x2]] of the
+        channels with the given names, all channels if None."""
+        names = self.names if channels is None else channels
+        window = (slice(*boundaries[0]), slice(*boundaries[1]))
+        return np.stack([np.asarray(self.channel(name)[window]) for name in names], axis = 2)
+
+    def __getitem__(self, key):
+        if not isinstance(key, tuple):
+            key = (key,)
+        key = key + (slice(None),) * (3 - len(key))
+        rows, cols, channels = key
+
+        # an integer channel index gives a 2D window, as for an ndarray
+
+        if isinstance(channels, (int, np.integer)):
+            return np.asarray(self.channels[channels][rows, cols])
+        selected = range(len(self.channels))[channels]
+        return np.stack([np.asarray(self.channels[k][rows, cols]) for k in selected], axis = 2)
+
+    def __len__(self):
+        return self.shape[0]
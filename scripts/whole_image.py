@@ -4,26 +4,86 @@ import os
 import time
 import sys
 import cv2 as cv
+import collections
+import queue
+import threading
+import tiling
+
+def region_properties(masks, origins = None, chunk_pixels = 2**22):
+	"""This function calculates the properties of a list of binary masks in one vectorized pass over their
+	pixels. origins contains the global coordinates of the top left pixel of every mask (zero by default).
+	Returns a dict of arrays, one row per mask:
+	area - number of pixels of the mask
+	centroid - global integer [row, column] centroid, as calculate_centroid always did: the mean pixel
+	index rounded down
+	bbox - global bounding box [y1, x1, y2, x2] of the pixels, y2 and x2 excluded
+	orientation - angle of the major axis from the row axis towards the column axis, in [-pi/2, pi/2],
+	from the second central moments: 0.5*atan2(2*mu_rc, mu_rr - mu_cc).
+	Masks must not be empty. Masks are processed by groups of about chunk_pixels pixels to bound memory."""
+	
+	n = len(masks)
+	if origins is None:
+		origins = np.zeros((n, 2), dtype = int)
+	origins = np.asarray(origins, dtype = int).reshape(n, 2)
+	if n == 0:
+		return {'area' : np.zeros(0, dtype = int), 'centroid' : np.zeros((0, 2), dtype = int),
+				'bbox' : np.zeros((0, 4), dtype = int), 'orientation' : np.zeros(0)}
+	
+	offsets = np.cumsum([0] + [mask.size for mask in masks])
+	
+	# large lists are split in two halves of about the same number of pixels
+	
+	if n > 1 and offsets[-1] > chunk_pixels:
+		half = min(max(int(np.searchsorted(offsets, offsets[-1] / 2)), 1), n - 1)
+		first = region_properties(masks[:half], origins[:half], chunk_pixels)
+		second = region_properties(masks[half:], origins[half:], chunk_pixels)
+		return {key : np.concatenate([first[key], second[key]]) for key in first}
+	
+	# pixels of all masks, with the mask they belong to and their coordinates in it
+	
+	widths = np.array([mask.shape[1] for mask in masks])
+	pixels = np.flatnonzero(np.concatenate([mask.ravel() for mask in masks]))
+	labels = np.searchsorted(offsets, pixels, side = 'right') - 1
+	rows, cols = np.divmod(pixels - offsets[labels], widths[labels])
+	
+	area = np.bincount(labels, minlength = n)
+	if (area == 0).any():
+		raise ValueError(f"masks {np.flatnonzero(area == 0).tolist()} are empty")
+	
+	# raw moments, exact in float64 for masks up to thousands of pixels wide
+	
+	m_r = np.bincount(labels, rows, n)
+	m_c = np.bincount(labels, cols, n)
+	m_rr = np.bincount(labels, rows * rows, n)
+	m_cc = np.bincount(labels, cols * cols, n)
+	m_rc = np.bincount(labels, rows * cols, n)
+	
+	# same integer convention as the former column by column sums: int(sum((i+1)*w)/sum(w)) - 1
+	
+	centroid = np.stack([np.floor((m_r + area) / area), np.floor((m_c + area) / area)], axis = 1).astype(int) - 1
+	centroid = centroid + origins
+	
+	# labels are sorted, so the pixels of every mask are a contiguous segment
+	
+	starts = np.searchsorted(labels, np.arange(n))
+	bbox = np.stack([np.minimum.reduceat(rows, starts), np.minimum.reduceat(cols, starts),
+					 np.maximum.reduceat(rows, starts) + 1, np.maximum.reduceat(cols, starts) + 1], axis = 1)
+	bbox = bbox + np.tile(origins, 2)
+	
+	mean_r = m_r / area
+	mean_c = m_c / area
+	mu_rr = m_rr / area - mean_r**2
+	mu_cc = m_cc / area - mean_c**2
+	mu_rc = m_rc / area - mean_r * mean_c
+	orientation = 0.5 * np.arctan2(2 * mu_rc, mu_rr - mu_cc)
+	
+	return {'area' : area, 'centroid' : centroid, 'bbox' : bbox, 'orientation' : orientation}
+
 
 def calculate_centroid(image):
     """ this function calculates the centroid of a mask"""    
     
-    # calculate x_2
-    
-    cum_sum = 0
-    for i in range(image.shape[1]):
-        cum_sum = cum_sum + np.sum(image[:,i].astype(int))*(i+1)
-    centroid_2 = int(cum_sum / np.sum(image.astype(int))) - 1
-    
-    # calculate x_1
-    cum_sum = 0
-    for j in range(image.shape[0]):
-        cum_sum = cum_sum + np.sum(image[j,:].astype(int))*(j+1)
-    centroid_1 = int(cum_sum / np.sum(image.astype(int))) - 1
-    
-    centroid = np.asarray([centroid_1 , centroid_2])
-    
-    return centroid
+    return region_properties([image])['centroid'][0]
 
 
 
@@ -36,257 +96,308 @@ def global_coord(centroid , coord_patch):
     
     return g_centroid
 
+
+def nearest(points, targets, chunk_size = 1024):
+	"""Returns for every point the index of the closest target, the first one in case of ties.
+	Distances are calculated by chunks of chunk_size points to bound memory."""
+	points = np.asarray(points)
+	targets = np.asarray(targets)
+	indices = []
+	for first in range(0, len(points), chunk_size):
+		differences = points[first:first + chunk_size, None, :] - targets[None, :, :]
+		indices.append(np.argmin(np.sum(differences * differences, axis = 2), axis = 1))
+	return np.concatenate(indices) if indices else np.zeros(0, dtype = int)
+
+
 def has_overlap(mask_1,mask_2,pd):
 	"""Check if two patches have a possible overlap. pd is the patch dimensions"""
 	return (np.absolute(mask_1['coord'] - mask_2['coord'])<pd).all()
 
 
 def has_conflict(mask_1,mask_2,pd):	
-	"""Check if two masks have an effective conflict. pd is the patch dimensions
+	"""Check if two detections have an effective conflict. pd is the patch dimensions
 	Conflict is present when more than 10 pixels coincide."""
-	overlap_coordinates = [[0,0],[0,0]]
-	overlap_in_image_1 = [[0,0],[0,0]]
-	overlap_in_image_2 = [[0,0],[0,0]]
 	
 	# overlap global coordinates
 	
-	overlap_coordinates[0][0] = np.max([mask_1['coord'][0],mask_2['coord'][0]])
-	overlap_coordinates[0][1] = np.min([mask_1['coord'][0] + pd[0], mask_2['coord'][0] + pd[0]])
-	overlap_coordinates[1][0] = np.max([mask_1['coord'][1],mask_2['coord'][1]])
-	overlap_coordinates[1][1] = np.min([mask_1['coord'][1] + pd[1], mask_2['coord'][1] + pd[1]])
+	y1 = max(mask_1['bbox'][0], mask_2['bbox'][0])
+	x1 = max(mask_1['bbox'][1], mask_2['bbox'][1])
+	y2 = min(mask_1['bbox'][2], mask_2['bbox'][2])
+	x2 = min(mask_1['bbox'][3], mask_2['bbox'][3])
 	
-	# overlap local coordinates
+	if y1 >= y2 or x1 >= x2:
+		return False
 	
-	overlap_in_image_1[0][0] = overlap_coordinates[0][0] - mask_1['coord'][0]
-	overlap_in_image_1[0][1] = overlap_coordinates[0][1] - mask_1['coord'][0]
-	overlap_in_image_1[1][0] = overlap_coordinates[1][0] - mask_1['coord'][1]
-	overlap_in_image_1[1][1] = overlap_coordinates[1][1] - mask_1['coord'][1]
+	# extract overlap from the cropped masks.
 	
-	overlap_in_image_2[0][0] = overlap_coordinates[0][0] - mask_2['coord'][0]
-	overlap_in_image_2[0][1] = overlap_coordinates[0][1] - mask_2['coord'][0]
-	overlap_in_image_2[1][0] = overlap_coordinates[1][0] - mask_2['coord'][1]
-	overlap_in_image_2[1][1] = overlap_coordinates[1][1] - mask_2['coord'][1]
+	overlap1 = mask_1['mask'][y1 - mask_1['bbox'][0]:y2 - mask_1['bbox'][0], x1 - mask_1['bbox'][1]:x2 - mask_1['bbox'][1]]
+	overlap2 = mask_2['mask'][y1 - mask_2['bbox'][0]:y2 - mask_2['bbox'][0], x1 - mask_2['bbox'][1]:x2 - mask_2['bbox'][1]]
+
+	return np.count_nonzero(overlap1 & overlap2)>10
 
-	# extract overlap.
-	
-	overlap1 = mask_1['mask'][overlap_in_image_1[0][0]:overlap_in_image_1[0][1],overlap_in_image_1[1][0]:overlap_in_image_1[1][1]]
-	overlap2 = mask_2['mask'][overlap_in_image_2[0][0]:overlap_in_image_2[0][1],overlap_in_image_2[1][0]:overlap_in_image_2[1][1]]
 
-	return np.sum(overlap1*overlap2)>10
+def compact_detection(mask, coord, class_id):
+	"""Returns a detection of a (height, width) boolean mask of the patch at coord, or None if the mask is
+	empty. Only the mask cropped to its bounding box is kept, with its global bounding box
+	[y1, x1, y2, x2] (y2 and x2 excluded) and its area. Removed detections are flagged as suppressed."""
+	rows = np.flatnonzero(mask.any(axis = 1))
+	if len(rows) == 0:
+		return None
+	cols = np.flatnonzero(mask.any(axis = 0))
+	
+	# the crop is copied, so that the full size masks of the model are freed
+	
+	crop = mask[rows[0]:rows[-1] + 1, cols[0]:cols[-1] + 1].copy()
+	y, x = int(coord[0]), int(coord[1])
+	return {'coord' : np.array(coord),
+			'class_id' : class_id,
+			'bbox' : [y + int(rows[0]), x + int(cols[0]), y + int(rows[-1]) + 1, x + int(cols[-1]) + 1],
+			'mask' : crop,
+			'area' : int(np.count_nonzero(crop)),
+			'suppressed' : False}
 
 
-def model_confl(model , image , patch_dimensions , min_ovl, suppress_over_mean = False, suppression_parameter = 3):
+def conflict_candidates(bboxes, cell_size):
+	"""Returns, for every bounding box, the sorted indices of the following ones which intersect it.
+	Bounding boxes are bucketed in a grid of cell_size cells, so only the ones sharing a cell are compared
+	and the cost grows with the number of masks rather than with the number of pairs."""
+	
+	grid = collections.defaultdict(list)
+	for k, bbox in enumerate(bboxes):
+		for cell_y in range(bbox[0] // cell_size[0], (bbox[2] - 1) // cell_size[0] + 1):
+			for cell_x in range(bbox[1] // cell_size[1], (bbox[3] - 1) // cell_size[1] + 1):
+				grid[(cell_y, cell_x)].append(k)
+	
+	# cells list their boxes by increasing index
+	
+	candidates = [set() for _ in bboxes]
+	for cell in grid.values():
+		for a in range(len(cell)):
+			bbox_a = bboxes[cell[a]]
+			for b in cell[a+1:]:
+				bbox_b = bboxes[b]
+				if bbox_a[0] < bbox_b[2] and bbox_b[0] < bbox_a[2] and bbox_a[1] < bbox_b[3] and bbox_b[1] < bbox_a[3]:
+					candidates[cell[a]].add(b)
+	
+	return [sorted(candidate) for candidate in candidates]
+
+
+def solve_conflicts(masks, pd):
+	"""Suppresses conflicting detections of the same class, keeping the one with the biggest area. pd is
+	the patch dimensions. Pairs are checked in the order of masks, as every pair i < j would be, but only
+	detections with intersecting bounding boxes are compared: the other ones cannot have a conflict.
+	Returns the detections which are not suppressed."""
+	
+	for i, candidates in enumerate(conflict_candidates([mask['bbox'] for mask in masks], pd)):
+		for j in candidates:
+			
+			# suppressed detections are not compared any more
+			
+			if masks[i]['suppressed']:
+				break
+			if masks[j]['suppressed']:
+				continue
+			if has_overlap(masks[i],masks[j],pd) and has_conflict(masks[i],masks[j],pd):
+				
+				# masks are removed according to which has biggest area.
+				
+				if masks[i]['area']>masks[j]['area']:
+					masks[j]['suppressed'] = True
+				else:
+					masks[i]['suppressed'] = True
+	
+	return [mask for mask in masks if not mask['suppressed']]
+
+
+# marks the end of the items in the queues of run_pipeline
+
+_END = object()
+
+
+def run_pipeline(items, function, consumer, queue_size = 2):
+	""" This function calls function(item) on the main thread for every item of the iterable items, and
+	consumer(item, output) with its output. items are produced by a reader thread and consumer runs in a
+	post processing thread, both concurrently with function: they are connected by queues of at most
+	queue_size items, so that only a few items are in memory at the same time.
+	Outputs are consumed in the order of items. An exception of any thread stops the pipeline and is
+	raised here."""
+	
+	read_queue = queue.Queue(queue_size)
+	post_queue = queue.Queue(queue_size)
+	stop = threading.Event()
+	errors = []
+	
+	def read():
+		try:
+			for item in items:
+				if stop.is_set():
+					break
+				read_queue.put(item)
+		except BaseException as error:
+			errors.append(error)
+		finally:
+			read_queue.put(_END)
+	
+	def post():
+		while True:
+			entry = post_queue.get()
+			if entry is _END:
+				return
+			if stop.is_set():
+				continue
+			try:
+				consumer(*entry)
+			except BaseException as error:
+				errors.append(error)
+				stop.set()
+	
+	reader = threading.Thread(target = read, daemon = True)
+	post_processor = threading.Thread(target = post, daemon = True)
+	reader.start()
+	post_processor.start()
+	
+	try:
+		while not stop.is_set():
+			item = read_queue.get()
+			if item is _END:
+				break
+			post_queue.put((item, function(item)))
+	except BaseException:
+		stop.set()
+		raise
+	finally:
+		
+		# the reader may be waiting on a full queue, it is emptied until the reader is done
+		
+		while reader.is_alive():
+			try:
+				read_queue.get(timeout = 0.1)
+			except queue.Empty:
+				pass
+		post_queue.put(_END)
+		post_processor.join()
+	
+	if errors:
+		raise errors[0]
+
+
+def model_confl(model , image , patch_dimensions , min_ovl, suppress_over_mean = False, suppression_parameter = 3, pipelined = True):
 	""" This function applies a model over an image, dividing it in patches. Returns centroids of tissue and
 	magnetic masks, and tissue part orientation. Orientation is inferred from nearest mag mask and returned as a
 	versor.
-	model contains the keras model classify the results with
-	image contains the whole image to be segmented
+	model contains the keras model classify the results with. Patches are given to model.detect by
+	batches of model.config.BATCH_SIZE images.
+	image contains the whole image to be segmented, a (height, width, channels) array or a
+	wafer_image.WaferImage which reads each patch from the channel tifs without loading the whole image.
 	patch_dimensions contains the dimension of the single patch - [512,512] for our model
 	min_ovl is the minimum overlap to use in the validation to be sure that no slice is lost. should be 
 	the maximum possible slice dimension in pixels.
 	suppress_over_mean is a flag that can be used to remove centroids which belong to mask which have a too
 	small area. Used to remove corner misdetection.
-	In this case masks are removed when they have area < mean_area/suppression_parameter."""
+	In this case masks are removed when they have area < mean_area/suppression_parameter.
+	pipelined reads the next patches and unpacks the results of the previous batch in background threads
+	while the model runs on the current batch (see run_pipeline). Results are the same in both modes."""
 	
-	interpatch = [0,0]
+	# the image is divided in evenly spread patches overlapping by at least min_ovl, the last ones
+	# end at the image borders so that no pixel is lost. Same grid as the ordered database patches.
 	
-	# calculate new overlap to patch the image to have equidistant patches
-	# a few pixels are lost at the end of each image due to rounding errors.
+	tiles = tiling.tile_grid(image.shape, patch_dimensions, min_ovl)
 	
-	height = image.shape[0]
-	width = image.shape[1]
+	############################### classification
+	print('Applying model...')
+	start = time.time()
 	
-	n_patches = np.asarray([0,0])
+	# tiles are given to the model by batches of its BATCH_SIZE images
 	
-	n_patches[0] = int(np.ceil( (height - min_ovl)/(patch_dimensions[0] - min_ovl)))
-	n_patches[1] = int(np.ceil( (width - min_ovl)/(patch_dimensions[1] - min_ovl)))
+	batch_size = model.config.BATCH_SIZE
+	batches = [tiles[first_tile : first_tile + batch_size] for first_tile in range(0, len(tiles), batch_size)]
 	
-	interpatch[0] = int(np.floor( (height - patch_dimensions[0]) / (n_patches[0] - 1) ) )
-	interpatch[1] = int(np.floor( (width - patch_dimensions[0]) / (n_patches[1] - 1) ) )
+	def read_batch(batch):
+		
+		# patches are views of the image, or read from the channel tifs for a WaferImage
+		
+		batch_images = [np.asarray(tiling.tile_view(image, tile)) for tile in batch]
+		
+		# the last batch is completed with copies of its last patch, their results are discarded
+		
+		batch_images += [batch_images[-1]] * (batch_size - len(batch))
+		
+		return batch, batch_images
 	
-	patch_counter = 0
+	def detect(batch_item):
+		batch, batch_images = batch_item
+		return model.detect(batch_images)[:len(batch)]
 	
-	############################### classification
-	print('Applying model...')
-    start = time.time()
-	r = []
-	for i in range(n_patches[0]):            
-		for j in range(n_patches[1]):
-			
-			# define patch boundaries and coordinates
-			
-			start_x1 = interpatch[0] * i
-			start_x2 = interpatch[1] * j
-			
-			end_x1 = start_x1 + patch_dimensions[0]
-			end_x2 = start_x2 + patch_dimensions[1]
-
-			patch_image = image[start_x1 : end_x1 , start_x2 : end_x2, :]
-			
-			coord_patch = np.array([start_x1 , start_x2])
-			
-			# apply the model
-			
-			result = model.detect([patch_image])[0]
-			
-			# add patch coordinates to the result for our purposes
-			
-			result['coord'] = coord_patch
-			
-			r.append(result)
-	
-	# masks are now put singularly as new arrays into a separate list, and divided over their class
+	# masks are put singularly as compact detections into a separate list, and divided over their class.
+	# empty masks are dropped.
 	
 	masks = []
 	
-	for i in range(len(r)):
-		for j in range(len(r[i]['class_ids'])):
-			tmp = {}
-			tmp['coord'] = r[i]['coord']
-			tmp['class_id'] = r[i]['class_ids'][j]
-			tmp['mask'] = r[i]['masks'][:,:,j]
-			masks.append(tmp)
+	def unpack(batch_item, results):
+		for tile, result in zip(batch_item[0], results):
+			for j in range(len(result['class_ids'])):
+				
+				# patch coordinates give the global position of the mask
+				
+				detection = compact_detection(result['masks'][:,:,j], tile.origin, result['class_ids'][j])
+				if detection is not None:
+					masks.append(detection)
+	
+	batch_items = (read_batch(batch) for batch in batches)
+	
+	if pipelined:
+		run_pipeline(batch_items, detect, unpack)
+	else:
+		for batch_item in batch_items:
+			unpack(batch_item, detect(batch_item))
 	
 	tissue_masks = [mask for mask in masks if mask['class_id'] == 1]
 	mag_masks = [mask for mask in masks if mask['class_id'] == 2]
 	
-    end = time.time()
-    print(f'Done! Elapsed time: {end-start}')
+	end = time.time()
+	print(f'Done! Elapsed time: {end-start}')
 	################################### conflicts resolution
 	print('Solving conflicts..')
 	start = time.time()
 	
-	# every possible mask pair is checked within same class.
-	
-	for i in range(len(tissue_masks)):
-		for j in range(i+1,len(tissue_masks)):
-			if has_overlap(tissue_masks[i],tissue_masks[j],patch_dimensions):
-				if has_conflict(tissue_masks[i],tissue_masks[j],patch_dimensions):
-					
-					# masks are removed according to which has biggest area.
-					# they are set to all zero images in order not to interfere with other conflicts.
-					
-					if np.sum(tissue_masks[i]['mask'])>np.sum(tissue_masks[j]['mask']):
-						tissue_masks[j]['mask'] = np.zeros(patch_dimensions).astype(bool)
-					else:
-						tissue_masks[i]['mask'] = np.zeros(patch_dimensions).astype(bool)
-						continue
-	
-	# remove empty masks
-	
-	tissue_masks = [mask for mask in tissue_masks if mask['mask'].any()]
-
-	for i in range(len(mag_masks)):
-		for j in range(i+1,len(mag_masks)):
-			if has_overlap(mag_masks[i],mag_masks[j],patch_dimensions):
-				if has_conflict(mag_masks[i],mag_masks[j],patch_dimensions):
-					
-					# masks are removed according to which has biggest area.
-					# they are set to all zero images in order not to interfere with other conflicts.
-					
-					if np.sum(mag_masks[i]['mask'])>np.sum(mag_masks[j]['mask']):
-						mag_masks[j]['mask'] = np.zeros(patch_dimensions).astype(bool)
-					else:
-						mag_masks[i]['mask'] = np.zeros(patch_dimensions).astype(bool)
-						continue
-	
-	# remove empty masks
-	
-	mag_masks = [mask for mask in mag_masks if mask['mask'].any()]
+	# mask pairs are checked within same class, only between spatially neighbouring masks.
+	
+	tissue_masks = solve_conflicts(tissue_masks, patch_dimensions)
+	mag_masks = solve_conflicts(mag_masks, patch_dimensions)
 	
 	end = time.time()
-    print(f'Done! Elapsed time: {end-start}')
+	print(f'Done! Elapsed time: {end-start}')
 	
 	####################### centroids calculation 
 	
-    print('Calculating results...')
-    start = time.time()
-    
-	centroids_tissue = []
-	centroids_mag = []
-	orientations = []
-	tissue_area = []
-	mag_area = []
-	
-	for i in range(len(tissue_masks)):
-		
-		# add centroid to mask
-		
-		tissue_masks[i]['centroid'] = []
-		rel_centroid = calculate_centroid(tissue_masks[i]['mask'])
-		tissue_masks[i]['centroid'] = rel_centroid + tissue_masks[i]['coord']
-		
-		# add centroid to centroid list
-		
-		centroids_tissue.append(tissue_masks[i]['centroid'])
-		
-		# add area to area list
-		
-		tissue_area.append(np.sum(tissue_masks[i]['mask']))
-	
-	#calculate mean area
-	
-	tissue_mean_area = np.mean(tissue_area) 
-	
-	if suppress_over_mean:
-		
-		# discard small masks
-		
-		centroids_tissue = [centroids_tissue[i] for i in range(len(centroids_tissue)) if tissue_area[i]>=tissue_mean_area/suppression_parameter]
-	
-	centroids_tissue = np.stack(centroids_tissue, axis=0)
+	print('Calculating results...')
+	start = time.time()
 	
-	for i in range(len(mag_masks)):
-		
-		# add centroid to mask
-		
-		mag_masks[i]['centroid'] = []
-		rel_centroid = calculate_centroid(mag_masks[i]['mask'])
-		mag_masks[i]['centroid']= rel_centroid + mag_masks[i]['coord']
-		
-		# add centroid to centroid list
-		
-		centroids_mag.append(mag_masks[i]['centroid'])
-		
-		# add area to area list
-		
-		mag_area.append(np.sum(mag_masks[i]['mask']))
+	# properties of all masks of a class are calculated at once, on the cropped masks
 	
-	# calculate mean area
+	tissue_properties = region_properties([mask['mask'] for mask in tissue_masks], [mask['bbox'][:2] for mask in tissue_masks])
+	mag_properties = region_properties([mask['mask'] for mask in mag_masks], [mask['bbox'][:2] for mask in mag_masks])
 	
-	mag_mean_area = np.mean(mag_area) 
+	centroids_tissue = tissue_properties['centroid']
+	tissue_area = tissue_properties['area']
+	centroids_mag = mag_properties['centroid']
+	mag_area = mag_properties['area']
 	
 	if suppress_over_mean:
 		
-		# discard small masks
+		# discard small masks, with area < mean area/suppression_parameter
 		
-		centroids_mag = [centroids_mag[i] for i in range(len(centroids_mag)) if mag_area[i]>=mag_mean_area/suppression_parameter]
-	
-	centroids_mag = np.stack(centroids_mag, axis=0)    
+		centroids_tissue = centroids_tissue[tissue_area>=np.mean(tissue_area)/suppression_parameter]
+		centroids_mag = centroids_mag[mag_area>=np.mean(mag_area)/suppression_parameter]
 	
 	###################### orientation calculation 
 	
 	
-	for i in range(len(centroids_tissue)):
-		
-		# find closest mag centroid and infer orientation from it.
-		
-		min_distance = float('inf')
-		
-		for j in range(len(centroids_mag)):
-			
-			distance = np.linalg.norm(centroids_tissue[i] - centroids_mag[j])
-			
-			if distance < min_distance:
-				index = j
-				min_distance = distance
-		
-		vector = (centroids_tissue[i]-centroids_mag[index])
-		
-		orientations.append(vector/np.linalg.norm(vector))
+	# find closest mag centroid and infer orientation from it.
 	
-	orientations = np.stack(orientations)
+	vectors = centroids_tissue - centroids_mag[nearest(centroids_tissue, centroids_mag)]
+	orientations = vectors/np.linalg.norm(vectors, axis=1, keepdims=True)
 	
-    end = time.time()
-    print(f'Done! Elapsed time: {end-start}')
+	end = time.time()
+	print(f'Done! Elapsed time: {end-start}')
 	return centroids_tissue, centroids_mag, orientations